@@ -1,27 +1,31 @@
 import argparse
 import ConfigParser
 import getpass
-import gzip
 import os
+import random
 import re
 import stat
 import subprocess
 import sys
 import tarfile
+import tempfile
 import time
 import urllib
 import urllib2
 import zlib
 
+from contextlib import closing
+
 try:
     import simplejson as json
 except ImportError:
     import json
 
 from gondor import __version__
-from gondor import http, utils
+from gondor import agent, batch, client, compression, delta, deployqueue, history, http, http2, static, tasks
+from gondor import spool, throttle, utils, watch, wheelhouse
 from gondor.api import make_api_call
-from gondor.progressbar import ProgressBar
+from gondor.meter import TransferMeter, format_bytes
 
 
 out = utils.out
@@ -37,6 +41,14 @@ EMAIL_RE = re.compile(
     re.IGNORECASE)
 DEFAULT_ENDPOINT = "https://api.gondor.io"
 
+# instances per page when the API paginates gondor list
+LIST_PAGE_SIZE = 100
+LIST_FIELDS = ["label", "kind", "url", "last_deployment.sha"]
+
+# seconds between checks while a deploy --queue waits its turn
+QUEUE_BACKOFF = 2
+QUEUE_MAX_BACKOFF = 60
+
 
 def config_value(config, section, key, default=None):
     try:
@@ -45,6 +57,21 @@ def config_value(config, section, key, default=None):
         return default
 
 
+def upload_handlers(config, label):
+    """
+    Returns a TransferMeter for an upload and the handlers which send it as
+    multipart/form-data, reporting progress to the meter and honouring
+    limit_rate.
+    """
+    meter = TransferMeter(label)
+    bucket = throttle.get_bucket(config["limit_rate"])
+    return meter, [
+        http.MultipartPostHandler,
+        http.UploadProgressHandler(meter, ssl=True, bucket=bucket),
+        http.UploadProgressHandler(meter, ssl=False, bucket=bucket)
+    ]
+
+
 def cmd_init(args, config):
     site_key = args.site_key[0]
     if len(site_key) < 11:
@@ -143,8 +170,7 @@ def cmd_create(args, config):
         vcs = "git"
     
     out("Reading configuration... ")
-    local_config = ConfigParser.RawConfigParser()
-    local_config.read(os.path.join(project_root, gondor_dirname, "config"))
+    local_config = utils.read_config(os.path.join(project_root, gondor_dirname, "config"))
     endpoint = config_value(local_config, "gondor", "endpoint", DEFAULT_ENDPOINT)
     site_key = local_config.get("gondor", "site_key")
     out("[ok]\n")
@@ -179,6 +205,203 @@ def cmd_create(args, config):
         error("%s\n" % data["message"])
 
 
+bandwidth_history = compression.BandwidthHistory()
+
+
+def choose_compression(config, endpoint, tar_path, ranges):
+    bandwidth = bandwidth_history.get(endpoint)
+    if config["limit_rate"]:
+        bandwidth = min(bandwidth or config["limit_rate"], config["limit_rate"])
+    if not bandwidth:
+        # nothing to go on until the first upload has been timed
+        out("Compression: no upload history for %s yet; using level %d\n" % (
+            endpoint, compression.DEFAULT_LEVEL
+        ))
+        return compression.DEFAULT_LEVEL
+    out("Choosing compression level... ")
+    level, compress_time, upload_time = compression.choose_level(tar_path, bandwidth, ranges)
+    out("[ok]\n")
+    out("Compression: level %d (predicted %.1fs to compress + %.1fs to upload at %s/s)\n" % (
+        level, compress_time, upload_time, format_bytes(bandwidth)
+    ))
+    return level
+
+
+wheel_cache = wheelhouse.Wheelhouse()
+
+
+def push_wheelhouse(config, endpoint, site_key, tar_path, requirements_file, tag):
+    """
+    Builds (or reuses) wheels for the requirements file in the archive at
+    tar_path and uploads the ones Gondor does not have yet. Returns the
+    wheelhouse to send with the deploy, or None to have Gondor run pip as
+    usual.
+    """
+    with closing(tarfile.open(tar_path)) as tar:
+        requirements = wheelhouse.read_requirements(tar, requirements_file)
+    if requirements is None:
+        out("WARNING: %s is not in the archive; not building wheels\n" % requirements_file)
+        return None
+    key = wheelhouse.cache_key(requirements, tag)
+    wheels = wheel_cache.wheels(key)
+    if wheels is None:
+        out("Building wheels for %s... " % requirements_file)
+        try:
+            wheels = wheel_cache.build(key, requirements, tag)
+        except wheelhouse.BuildError, e:
+            out("[failed]\n")
+            out("WARNING: %s\nRequirements will be installed on Gondor instead.\n" % e)
+            return None
+        out("[ok]\n")
+    else:
+        out("Reusing wheels for %s... [ok]\n" % requirements_file)
+    
+    description = {
+        "key": key,
+        "platform": tag,
+        "wheels": [{"name": name, "sha256": digest} for name, path, digest in wheels],
+    }
+    out("Checking wheelhouse on Gondor... ")
+    params = {
+        "version": __version__,
+        "site_key": site_key,
+        "wheelhouse": json.dumps(description),
+    }
+    try:
+        response = make_api_call(config, "%s/wheelhouse/missing/" % endpoint, urllib.urlencode(params))
+        data = json.loads(response.read())
+    except urllib2.URLError, e:
+        # older API versions do not know about wheelhouses
+        out("[failed]\n")
+        out("WARNING: unable to check wheelhouse (%s)\nRequirements will be installed on Gondor instead.\n" % e)
+        return None
+    if data["status"] != "success":
+        out("[failed]\n")
+        out("WARNING: %s\nRequirements will be installed on Gondor instead.\n" % data["message"])
+        return None
+    if data.get("platform", tag) != tag:
+        out("[failed]\n")
+        out("WARNING: wheels are for %s but Gondor runs %s (set [app] wheelhouse_platform)\n"
+            "Requirements will be installed on Gondor instead.\n" % (tag, data["platform"]))
+        return None
+    out("[ok]\n")
+    
+    missing = set(data["missing"])
+    upload = [(name, path) for name, path, digest in wheels if name in missing]
+    if not upload:
+        return description
+    out("Pushing %d of %d wheels to Gondor... \n" % (len(upload), len(wheels)))
+    files = []
+    try:
+        params = [
+            ("version", __version__),
+            ("site_key", site_key),
+            ("key", key),
+        ]
+        for name, path in upload:
+            fp = open(path, "rb")
+            files.append(fp)
+            params.append(("wheel", fp))
+        meter, handlers = upload_handlers(config, "wheels")
+        try:
+            response = make_api_call(config, "%s/wheelhouse/upload/" % endpoint, params, extra_handlers=handlers)
+            data = json.loads(response.read())
+        except urllib2.URLError, e:
+            out("WARNING: unable to push wheels (%s)\nRequirements will be installed on Gondor instead.\n" % e)
+            return None
+    finally:
+        for fp in files:
+            fp.close()
+    if data["status"] != "success":
+        out("WARNING: %s\nRequirements will be installed on Gondor instead.\n" % data["message"])
+        return None
+    return description
+
+
+def push_static(config, endpoint, site_key, tar_path, prefix, site_media_url):
+    """
+    Uploads the static assets in the archive at tar_path which Gondor does
+    not have yet and removes all of them from the archive. Returns the
+    manifest to send with the deploy, or None to leave the assets in the
+    tarball.
+    """
+    with closing(tarfile.open(tar_path)) as tar:
+        assets = static.collect(tar, prefix)
+    if not assets:
+        return None
+    hashes = set(sha for sha, member in assets.itervalues())
+    out("Checking %d static assets on Gondor... " % len(assets))
+    params = {
+        "version": __version__,
+        "site_key": site_key,
+        "site_media_url": site_media_url or "",
+        "hashes": json.dumps(sorted(hashes)),
+    }
+    try:
+        response = make_api_call(config, "%s/static/missing/" % endpoint, urllib.urlencode(params))
+        data = json.loads(response.read())
+    except urllib2.URLError, e:
+        # older API versions do not know about static manifests
+        out("[failed]\n")
+        out("WARNING: unable to check static assets (%s); shipping them in the tarball\n" % e)
+        return None
+    if data["status"] != "success":
+        out("[failed]\n")
+        out("WARNING: %s; shipping static assets in the tarball\n" % data["message"])
+        return None
+    out("[ok]\n")
+    
+    missing = hashes & set(data["missing"])
+    if missing:
+        fd, bundle_tar = tempfile.mkstemp(suffix=".tar")
+        os.close(fd)
+        bundle_path = "%s.gz" % bundle_tar
+        try:
+            count = static.write_bundle(tar_path, assets, missing, bundle_tar)
+            compression.write_tarball(bundle_tar, bundle_path, 6)
+            out("Pushing %d new static assets to Gondor... \n" % count)
+            with open(bundle_path, "rb") as bundle:
+                params = {
+                    "version": __version__,
+                    "site_key": site_key,
+                    "bundle": bundle,
+                }
+                meter, handlers = upload_handlers(config, "static")
+                try:
+                    response = make_api_call(config, "%s/static/upload/" % endpoint, params, extra_handlers=handlers)
+                    data = json.loads(response.read())
+                except urllib2.URLError, e:
+                    out("WARNING: unable to push static assets (%s); shipping them in the tarball\n" % e)
+                    return None
+        finally:
+            for path in [bundle_tar, bundle_path]:
+                if os.path.exists(path):
+                    os.unlink(path)
+        if data["status"] != "success":
+            out("WARNING: %s; shipping static assets in the tarball\n" % data["message"])
+            return None
+    
+    static.strip(tar_path, [member for sha, member in assets.itervalues()])
+    return {
+        "site_media_url": site_media_url,
+        "assets": dict((path, sha) for path, (sha, member) in assets.iteritems()),
+    }
+
+
+def archive_paths(project_root, repo_root, shared_paths):
+    """
+    Returns the repository relative paths archived for a subtree deploy:
+    the project itself and any shared paths declared in [files] shared.
+    """
+    paths = [os.path.relpath(project_root, repo_root)]
+    for path in shared_paths:
+        path = os.path.normpath(path)
+        if path.startswith("..") or os.path.isabs(path):
+            error("shared path '%s' must be inside the repository\n" % path)
+        paths.append(path)
+    return paths
+
+
 def cmd_deploy(args, config):
     label = args.label[0]
     commit = args.commit[0]
@@ -190,11 +413,11 @@ def cmd_deploy(args, config):
         error("unable to find a .gondor directory.\n")
     
     tar_path, tarball_path = None, None
+    queue = None
     
     try:
         out("Reading configuration... ")
-        local_config = ConfigParser.RawConfigParser()
-        local_config.read(os.path.join(project_root, gondor_dirname, "config"))
+        local_config = utils.read_config(os.path.join(project_root, gondor_dirname, "config"))
         endpoint = config_value(local_config, "gondor", "endpoint", DEFAULT_ENDPOINT)
         site_key = local_config.get("gondor", "site_key")
         vcs = local_config.get("gondor", "vcs")
@@ -205,11 +428,25 @@ def cmd_deploy(args, config):
             "staticfiles": config_value(local_config, "app", "staticfiles"),
             "site_media_url": config_value(local_config, "app", "site_media_url"),
         }
+        use_wheelhouse = args.wheelhouse or config_value(local_config, "app", "wheelhouse", "off") == "on"
+        use_static_manifest = args.static_manifest or config_value(local_config, "app", "static_manifest", "off") == "on"
+        wheelhouse_platform = config_value(local_config, "app", "wheelhouse_platform", wheelhouse.platform_tag())
+        if use_wheelhouse:
+            try:
+                wheelhouse.parse_tag(wheelhouse_platform)
+            except ValueError, e:
+                error("%s\n" % e)
         include_files = [
             x.strip()
             for x in config_value(local_config, "files", "include", "").split("\n")
             if x
         ]
+        subtree = config_value(local_config, "files", "subtree", "off") == "on"
+        shared_paths = [
+            x.strip()
+            for x in config_value(local_config, "files", "shared", "").split("\n")
+            if x
+        ]
         out("[ok]\n")
         
         if vcs == "git":
@@ -224,6 +461,9 @@ def cmd_deploy(args, config):
                 commit = sha
             tar_path = os.path.abspath(os.path.join(repo_root, "%s-%s.tar" % (label, sha)))
             cmd = ["git", "archive", "--format=tar", commit, "-o", tar_path]
+            if subtree:
+                cmd.append("--")
+                cmd.extend(archive_paths(project_root, repo_root, shared_paths))
         elif vcs == "hg":
             try:
                 repo_root = utils.find_nearest(os.getcwd(), ".hg")
@@ -241,10 +481,26 @@ def cmd_deploy(args, config):
             except KeyError:
                 error("could not map '%s' to a SHA\n" % commit)
             tar_path = os.path.abspath(os.path.join(repo_root, "%s-%s.tar" % (label, sha)))
-            cmd = ["hg", "archive", "-p", ".", "-t", "tar", "-r", commit, tar_path]
+            cmd = ["hg", "archive", "-p", ".", "-t", "tar", "-r", commit]
+            if subtree:
+                for path in archive_paths(project_root, repo_root, shared_paths):
+                    cmd.extend(["-I", "path:%s" % path])
+            cmd.append(tar_path)
         else:
             error("'%s' is not a valid version control system for Gondor\n" % vcs)
         
+        operation = history.current()
+        operation.set(sha=sha)
+        operation.mark("prepare")
+        
+        if args.queue:
+            queue = deployqueue.DeployQueue(endpoint, site_key, label)
+            ticket = queue.add(sha)
+            if not wait_turn(queue, ticket, label, sha):
+                operation.set(status="superseded")
+                return
+            operation.mark("queue")
+        
         out("Archiving code from %s... " % commit)
         check, output = utils.run_proc(cmd, cwd=repo_root)
         if check != 0:
@@ -260,100 +516,282 @@ def cmd_deploy(args, config):
             finally:
                 tar_fp.close()
             out("[ok]\n")
+        operation.mark("archive")
+        
+        if use_wheelhouse and app_config["requirements_file"]:
+            requirements_file = os.path.join(
+                os.path.relpath(project_root, repo_root),
+                app_config["requirements_file"]
+            )
+            app_config["wheelhouse"] = push_wheelhouse(
+                config, endpoint, site_key, tar_path, requirements_file, wheelhouse_platform
+            )
+            operation.mark("wheelhouse")
+        
+        static_manifest = None
+        if use_static_manifest and app_config["staticfiles"] == "on":
+            static_manifest = push_static(
+                config,
+                endpoint,
+                site_key,
+                tar_path,
+                os.path.relpath(project_root, repo_root),
+                app_config["site_media_url"]
+            )
+            operation.mark("static")
         
         tarball_path = os.path.abspath(os.path.join(repo_root, "%s-%s.tar.gz" % (label, sha)))
         
+        ranges = compression.plan(tar_path)
+        level = config["compression"]
+        if level == "auto":
+            level = choose_compression(config, endpoint, tar_path, ranges)
+        
         out("Building tarball... ")
-        with open(tar_path, "rb") as tar_fp:
-            try:
-                tarball = gzip.open(tarball_path, mode="wb")
-                tarball.writelines(tar_fp)
-            finally:
-                tarball.close()
-        out("[ok]\n")
+        stored = compression.write_tarball(tar_path, tarball_path, level, ranges)
+        if stored:
+            out("[ok] (%s already compressed, stored as is)\n" % format_bytes(stored))
+        else:
+            out("[ok]\n")
+        raw_bytes = os.path.getsize(tar_path)
+        tarball_bytes = os.path.getsize(tarball_path)
+        operation.set(
+            level=level,
+            raw_bytes=raw_bytes,
+            bytes=tarball_bytes,
+            ratio=float(tarball_bytes) / raw_bytes if raw_bytes else None
+        )
+        operation.mark("compress")
         
-        pb = ProgressBar(0, 100, 77)
-        out("Pushing tarball to Gondor... \n")
-        url = "%s/deploy/" % endpoint
+        params = {
+            "version": __version__,
+            "site_key": site_key,
+            "label": label,
+            "sha": sha,
+            "commit": commit,
+            "project_root": os.path.relpath(project_root, repo_root),
+            "app": json.dumps(app_config),
+        }
+        if static_manifest is not None:
+            params["static_manifest"] = json.dumps(static_manifest)
         
-        with open(tarball_path, "rb") as tarball:
-            params = {
-                "version": __version__,
-                "site_key": site_key,
-                "label": label,
-                "sha": sha,
-                "commit": commit,
-                "tarball": tarball,
-                "project_root": os.path.relpath(project_root, repo_root),
-                "app": json.dumps(app_config),
-            }
-            handlers = [
-                http.MultipartPostHandler,
-                http.UploadProgressHandler(pb, ssl=True),
-                http.UploadProgressHandler(pb, ssl=False)
-            ]
-            try:
-                response = make_api_call(config, url, params, extra_handlers=handlers)
-            except KeyboardInterrupt:
-                out("\nCanceling uploading... [ok]\n")
-                sys.exit(1)
-            except urllib2.HTTPError, e:
-                out("\nReceived an error [%d: %s]" % (e.code, e.read()))
-                sys.exit(1)
-            else:
-                out("\n")
-                data = json.loads(response.read())
+        attempt = 0
+        while True:
+            data = push_tarball(config, endpoint, tarball_path, params)
+            if data["status"] == "error":
+                error("%s\n" % data["message"])
+            if wait_for_deployment(config, endpoint, site_key, label, data, queue is not None):
+                break
+            # locked by a deployment already in progress; wait our turn
+            attempt += 1
+            delay = random.uniform(0.5, 1) * min(QUEUE_MAX_BACKOFF, QUEUE_BACKOFF * 2 ** attempt)
+            out("Another deployment is in progress; retrying in %d seconds...\n" % delay)
+            time.sleep(delay)
+            operation.mark("queue")
+            if queue.superseded(ticket):
+                out("Superseded by a newer deployment of %s; not deploying %s.\n" % (label, sha))
+                operation.set(status="superseded")
+                return
     
     finally:
         if tar_path and os.path.exists(tar_path):
             os.unlink(tar_path)
         if tarball_path and os.path.exists(tarball_path):
             os.unlink(tarball_path)
+        if queue is not None:
+            queue.remove(ticket)
+
+
+def wait_turn(queue, ticket, label, sha):
+    """
+    Waits until no older deploy of the instance is waiting or running on
+    this machine. Returns False if a newer deploy has been queued meanwhile.
+    """
+    attempt = 0
+    waiting = False
+    while True:
+        if queue.superseded(ticket):
+            if waiting:
+                out("[superseded]\n")
+            out("Superseded by a newer deployment of %s; not deploying %s.\n" % (label, sha))
+            return False
+        if queue.first(ticket):
+            if waiting:
+                out("[ok]\n")
+            return True
+        if not waiting:
+            out("Waiting for earlier deployments of %s... " % label)
+            waiting = True
+        attempt += 1
+        time.sleep(min(QUEUE_MAX_BACKOFF, QUEUE_BACKOFF * 2 ** attempt) * random.uniform(0.5, 1))
+
+
+def push_tarball(config, endpoint, tarball_path, params):
+    out("Pushing tarball to Gondor... \n")
+    meter, handlers = upload_handlers(config, "upload")
+    url = "%s/deploy/" % endpoint
     
-    if data["status"] == "error":
-        error("%s\n" % data["message"])
-    if data["status"] == "success":
-        deployment_id = data["deployment"]
-        if "url" in data:
-            instance_url = data["url"]
+    with open(tarball_path, "rb") as tarball:
+        params = dict(params, tarball=tarball)
+        try:
+            response = make_api_call(config, url, params, extra_handlers=handlers)
+        except KeyboardInterrupt:
+            out("\nCanceling uploading... [ok]\n")
+            sys.exit(1)
+        except urllib2.HTTPError, e:
+            out("\nReceived an error [%d: %s]" % (e.code, e.read()))
+            sys.exit(1)
         else:
-            instance_url = None
-        
-        # poll status of the deployment
-        out("Deploying... ")
-        while True:
-            params = {
-                "version": __version__,
-                "site_key": site_key,
-                "instance_label": label,
-                "task_id": deployment_id,
-            }
-            url = "%s/task_status/" % endpoint
-            try:
-                response = make_api_call(config, url, urllib.urlencode(params))
-            except urllib2.URLError:
-                # @@@ add max retries
+            data = json.loads(response.read())
+        if meter.ended is not None:
+            if config["limit_rate"] is None:
+                # a capped upload says nothing about the link;
+                # choose_compression applies limit_rate on its own
+                bandwidth_history.record(endpoint, meter.transferred, meter.ended - meter.started)
+            if meter.ended > meter.started:
+                history.current().set(upload_rate=meter.transferred / (meter.ended - meter.started))
+    history.current().mark("upload")
+    return data
+
+
+def wait_for_deployment(config, endpoint, site_key, label, data, queued=False):
+    """
+    Polls the deployment started by a successful /deploy/ response until it
+    finishes. Returns True once deployed; returns False when the instance
+    was locked by another deployment and queued is set (and exits
+    otherwise).
+    """
+    deployment_id = data["deployment"]
+    if "url" in data:
+        instance_url = data["url"]
+    else:
+        instance_url = None
+    
+    # poll status of the deployment
+    out("Deploying... ")
+    while True:
+        params = {
+            "version": __version__,
+            "site_key": site_key,
+            "instance_label": label,
+            "task_id": deployment_id,
+        }
+        try:
+            data = tasks.registry.status(config, endpoint, params)
+        except urllib2.URLError, e:
+            out("[error]\n")
+            error("unable to check status: %s\n" % e.reason)
+        if data["status"] == "error":
+            out("[error]\n")
+            error("%s\n" % data["message"])
+        if data["status"] == "success":
+            if data["state"] == "deployed":
+                out("[ok]\n")
+                history.current().mark("deploy")
+                if instance_url:
+                    out("\nVisit: %s\n" % instance_url)
+                return True
+            elif data["state"] == "failed":
+                out("[failed]\n")
+                out("\n%s\n" % data["reason"])
+                sys.exit(1)
+            elif data["state"] == "locked":
+                out("[locked]\n")
+                history.current().mark("deploy")
+                if queued:
+                    return False
+                out("\nYour deployment failed due to being locked. This means there is another deployment already in progress.\n")
+                sys.exit(1)
+            else:
+                time.sleep(2)
+
+
+def cmd_sync(args, config):
+    label = args.label[0]
+    
+    gondor_dirname = ".gondor"
+    try:
+        project_root = utils.find_nearest(os.getcwd(), gondor_dirname)
+    except OSError:
+        error("unable to find a .gondor directory.\n")
+    
+    out("Reading configuration... ")
+    local_config = utils.read_config(os.path.join(project_root, gondor_dirname, "config"))
+    endpoint = config_value(local_config, "gondor", "endpoint", DEFAULT_ENDPOINT)
+    site_key = local_config.get("gondor", "site_key")
+    vcs = local_config.get("gondor", "vcs")
+    out("[ok]\n")
+    
+    try:
+        repo_root = utils.find_nearest(os.getcwd(), ".%s" % vcs)
+    except OSError:
+        error("unable to find a .%s directory.\n" % vcs)
+    
+    w = watch.watcher(repo_root)
+    out("Watching %s for changes (^C to stop)...\n" % repo_root)
+    # changes from a failed push are retried along with the next batch
+    pending = set()
+    try:
+        for changed in watch.debounced(w, args.debounce):
+            pending |= changed
+            changed = pending
+            paths = sorted(os.path.relpath(path, repo_root) for path in changed)
+            if vcs == "git":
+                # leave out anything git ignores; check-ignore exits 1 when
+                # nothing matched
+                p = subprocess.Popen(
+                    ["git", "check-ignore", "--stdin", "-z"],
+                    cwd=repo_root, stdin=subprocess.PIPE, stdout=subprocess.PIPE
+                )
+                ignored = set(p.communicate("\0".join(paths))[0].split("\0"))
+                paths = [path for path in paths if path not in ignored]
+            if not paths:
+                pending = set()
                 continue
+            updated = [path for path in paths if os.path.isfile(os.path.join(repo_root, path))]
+            deleted = [path for path in paths if not os.path.exists(os.path.join(repo_root, path))]
+            out("Syncing %d changed and %d deleted file(s)... " % (len(updated), len(deleted)))
+            fd, patch_path = tempfile.mkstemp(suffix=".tar.gz")
+            os.close(fd)
+            try:
+                patch = tarfile.open(patch_path, "w:gz")
+                try:
+                    for path in updated:
+                        patch.add(os.path.join(repo_root, path), arcname=path)
+                finally:
+                    patch.close()
+                with open(patch_path, "rb") as patch:
+                    params = {
+                        "version": __version__,
+                        "site_key": site_key,
+                        "label": label,
+                        "project_root": os.path.relpath(project_root, repo_root),
+                        "deleted": json.dumps(deleted),
+                        "reload": "on",
+                        "patch": patch,
+                    }
+                    try:
+                        response = make_api_call(config, "%s/sync/" % endpoint, params,
+                            extra_handlers=[http.MultipartPostHandler]
+                        )
+                    except urllib2.HTTPError, e:
+                        out("[error]\nReceived an error [%d: %s]\n" % (e.code, e.read()))
+                        continue
+                    except urllib2.URLError, e:
+                        out("[error]\nunable to reach Gondor: %s\n" % e.reason)
+                        continue
+            finally:
+                os.unlink(patch_path)
             data = json.loads(response.read())
-            if data["status"] == "error":
-                out("[error]\n")
-                error("%s\n" % data["message"])
             if data["status"] == "success":
-                if data["state"] == "deployed":
-                    out("[ok]\n")
-                    if instance_url:
-                        out("\nVisit: %s\n" % instance_url)
-                    break
-                elif data["state"] == "failed":
-                    out("[failed]\n")
-                    out("\n%s\n" % data["reason"])
-                    sys.exit(1)
-                elif data["state"] == "locked":
-                    out("[locked]\n")
-                    out("\nYour deployment failed due to being locked. This means there is another deployment already in progress.\n")
-                    sys.exit(1)
-                else:
-                    time.sleep(2)
+                out("[ok]\n")
+                pending = set()
+            else:
+                out("[error]\n%s\n" % data["message"])
+    except KeyboardInterrupt:
+        out("\n")
+    finally:
+        w.close()
 
 
 def cmd_sqldump(args, config):
@@ -362,25 +800,55 @@ def cmd_sqldump(args, config):
     gondor_dirname = ".gondor"
     repo_root = utils.find_nearest(os.getcwd(), gondor_dirname)
     
-    local_config = ConfigParser.RawConfigParser()
-    local_config.read(os.path.join(repo_root, gondor_dirname, "config"))
+    local_config = utils.read_config(os.path.join(repo_root, gondor_dirname, "config"))
     endpoint = config_value(local_config, "gondor", "endpoint", DEFAULT_ENDPOINT)
     site_key = local_config.get("gondor", "site_key")
     
+    baseline = getattr(args, "baseline", None)
+    output = getattr(args, "output", None)
+    raw = getattr(args, "raw", False)
+    if baseline is not None and not os.path.isfile(baseline):
+        error("baseline %s does not exist\n" % baseline)
+    if raw and output is None:
+        error("--raw needs --output\n")
+    if raw and baseline is not None:
+        error("--raw cannot be combined with --baseline\n")
+    if output is not None and not os.path.isdir(os.path.dirname(os.path.abspath(output))):
+        error("directory for %s does not exist\n" % output)
+    
     # request SQL dump and stream the response through uncompression
     
-    err("Dumping database... ")
     url = "%s/sqldump/" % endpoint
     params = {
         "version": __version__,
         "site_key": site_key,
         "label": label,
     }
+    signature_path = None
     try:
-        response = make_api_call(config, url, urllib.urlencode(params))
+        if baseline is not None:
+            err("Signing baseline... ")
+            fd, signature_path = tempfile.mkstemp(suffix=".sig")
+            os.close(fd)
+            block_size, blocks = delta.write_signature(baseline, signature_path)
+            err("[ok] (%d blocks)\n" % blocks)
+            history.current().mark("signature")
+        err("Dumping database... ")
+        if signature_path is not None:
+            with open(signature_path, "rb") as signature:
+                params.update({
+                    "block_size": str(block_size),
+                    "signature": signature,
+                })
+                response = make_api_call(config, url, params, extra_handlers=[http.MultipartPostHandler])
+        else:
+            response = make_api_call(config, url, urllib.urlencode(params))
     except urllib2.HTTPError, e:
         out("\nReceived an error [%d: %s]" % (e.code, e.read()))
         sys.exit(1)
+    finally:
+        if signature_path is not None and os.path.exists(signature_path):
+            os.unlink(signature_path)
     data = json.loads(response.read())
     
     if data["status"] == "error":
@@ -394,19 +862,18 @@ def cmd_sqldump(args, config):
                 "instance_label": label,
                 "task_id": task_id,
             }
-            url = "%s/task_status/" % endpoint
             try:
-                response = make_api_call(config, url, urllib.urlencode(params))
-            except urllib2.URLError:
-                # @@@ add max retries
-                continue
-            data = json.loads(response.read())
+                data = tasks.registry.status(config, endpoint, params)
+            except urllib2.URLError, e:
+                err("[error]\n")
+                error("unable to check status: %s\n" % e.reason)
             if data["status"] == "error":
                 err("[error]\n")
                 error("%s\n" % data["message"])
             if data["status"] == "success":
                 if data["state"] == "finished":
                     err("[ok]\n")
+                    history.current().mark("dump")
                     break
                 elif data["state"] == "failed":
                     err("[failed]\n")
@@ -421,14 +888,142 @@ def cmd_sqldump(args, config):
                 else:
                     time.sleep(2)
     
+    result = data["result"]
+    if output is not None:
+        # written next to output and renamed over it once complete, so
+        # output may also be the baseline
+        dest = spool.SpoolFile(output)
+    else:
+        dest = sys.stdout
+    try:
+        meter = None
+        if raw:
+            meter = fetch_sqldump_raw(config, result, dest)
+        elif baseline is not None:
+            if "delta_url" in result:
+                meter = fetch_sqldump_delta(config, result, baseline, block_size, dest)
+            else:
+                err("WARNING: Gondor did not return a delta; downloading the full dump\n")
+        if meter is None:
+            meter = fetch_sqldump(config, result["public_url"], dest)
+        if output is not None:
+            dest.commit()
+    finally:
+        if output is not None:
+            dest.close()
+    operation = history.current()
+    operation.mark("download")
+    operation.set(bytes=meter.transferred)
+    if meter.ended is not None and meter.ended > meter.started:
+        operation.set(download_rate=meter.transferred / (meter.ended - meter.started))
+
+
+def fetch_sqldump(config, url, dest):
+    """
+    Streams the compressed dump at url to dest as plain SQL. Returns the
+    transfer meter.
+    """
     d = zlib.decompressobj(16+zlib.MAX_WBITS)
     cs = 16 * 1024
-    response = urllib2.urlopen(data["result"]["public_url"])
+    bucket = throttle.get_bucket(config["limit_rate"])
+    response = urllib2.urlopen(url)
+    total = response.info().getheader("Content-Length")
+    if total is not None:
+        total = int(total)
+    meter = TransferMeter("download", total)
     while True:
         chunk = response.read(cs)
         if not chunk:
             break
-        out(d.decompress(chunk))
+        if bucket is not None:
+            bucket.consume(len(chunk))
+        meter.add(len(chunk))
+        dest.write(d.decompress(chunk))
+        dest.flush()
+    meter.finish()
+    return meter
+
+
+def fetch_sqldump_raw(config, result, dest):
+    """
+    Writes the compressed dump described by result to dest as is, checking
+    the gzip stream and Gondor's sha256 of it (when given) on the way.
+    Returns the transfer meter.
+    """
+    # large reads and writes keep the copy sequential and the per-chunk
+    # overhead low; there is no decompression and nothing to re-compress
+    cs = 1024 * 1024
+    bucket = throttle.get_bucket(config["limit_rate"])
+    response = urllib2.urlopen(result["public_url"])
+    total = response.info().getheader("Content-Length")
+    if total is not None:
+        total = int(total)
+    meter = TransferMeter("download", total)
+    verifier = spool.GzipVerifier()
+    try:
+        while True:
+            chunk = response.read(cs)
+            if not chunk:
+                break
+            if bucket is not None:
+                bucket.consume(len(chunk))
+            meter.add(len(chunk))
+            verifier.update(chunk)
+            dest.write(chunk)
+        meter.finish()
+        if total is not None and meter.transferred != total:
+            raise spool.VerifyError("received %d of %d bytes" % (meter.transferred, total))
+        verifier.verify(result.get("public_sha256"))
+    except spool.VerifyError, e:
+        meter.finish()
+        error("dump failed verification: %s\n" % e)
+    return meter
+
+
+def fetch_sqldump_delta(config, result, baseline, block_size, dest):
+    """
+    Rebuilds the dump from baseline and the delta described by result and
+    writes it to dest once its sha256 matches. Returns the transfer meter,
+    or None when the full dump has to be downloaded instead.
+    """
+    expected = result.get("sha256")
+    if expected is None:
+        err("WARNING: Gondor sent no checksum for the delta; downloading the full dump\n")
+        return None
+    fd, rebuilt_path = tempfile.mkstemp(suffix=".sql")
+    try:
+        meter = None
+        with os.fdopen(fd, "wb") as rebuilt:
+            try:
+                response = urllib2.urlopen(result["delta_url"])
+                total = response.info().getheader("Content-Length")
+                if total is not None:
+                    total = int(total)
+                meter = TransferMeter("delta", total)
+                reader = delta.DeltaReader(response, meter, throttle.get_bucket(config["limit_rate"]))
+                sha, size = delta.apply(reader, baseline, block_size, rebuilt)
+                meter.finish()
+            except (urllib2.URLError, delta.DeltaError, IOError), e:
+                if meter is not None:
+                    meter.finish()
+                err("WARNING: unable to apply delta (%s); downloading the full dump\n" % e)
+                return None
+        if sha != expected or size != result.get("size", size):
+            err("WARNING: rebuilt dump does not match Gondor's checksum; downloading the full dump\n")
+            return None
+        err("Rebuilt %s dump from %s of changes\n" % (
+            format_bytes(size), format_bytes(meter.transferred)
+        ))
+        with open(rebuilt_path, "rb") as rebuilt:
+            while True:
+                chunk = rebuilt.read(64 * 1024)
+                if not chunk:
+                    break
+                dest.write(chunk)
+        dest.flush()
+        return meter
+    finally:
+        os.unlink(rebuilt_path)
 
 
 def cmd_run(args, config):
@@ -445,8 +1040,7 @@ def cmd_run(args, config):
         error("unable to find a .gondor directory.\n")
     
     out("Reading configuration... ")
-    local_config = ConfigParser.RawConfigParser()
-    local_config.read(os.path.join(project_root, gondor_dirname, "config"))
+    local_config = utils.read_config(os.path.join(project_root, gondor_dirname, "config"))
     endpoint = config_value(local_config, "gondor", "endpoint", DEFAULT_ENDPOINT)
     site_key = local_config.get("gondor", "site_key")
     vcs = local_config.get("gondor", "vcs")
@@ -538,23 +1132,39 @@ def cmd_run(args, config):
         error("%s\n" % data["message"])
     if data["status"] == "success":
         task_id = data["task"]
+        # servers which stream output hand back only the output produced
+        # since output_offset along with the cursor for the next poll
+        output_offset = 0
+        streamed = False
         while True:
             params = {
                 "version": __version__,
                 "site_key": site_key,
                 "instance_label": instance_label,
                 "task_id": task_id,
+                "output_offset": output_offset,
             }
-            url = "%s/task_status/" % endpoint
-            response = make_api_call(config, url, urllib.urlencode(params))
-            data = json.loads(response.read())
+            try:
+                data = tasks.registry.status(config, endpoint, params)
+            except urllib2.URLError, e:
+                out("[error]\n")
+                error("unable to check status: %s\n" % e.reason)
             if data["status"] == "error":
                 out("[error]\n")
                 out("\nError: %s\n" % data["message"])
             if data["status"] == "success":
+                chunk = data.get("output")
+                if chunk:
+                    if not streamed:
+                        out("\n\n")
+                        streamed = True
+                    out(chunk)
+                if "output_offset" in data:
+                    output_offset = data["output_offset"]
                 if data["state"] == "executed":
-                    out("[ok]\n")
-                    out("\n%s" % data["result"]["output"])
+                    if not streamed:
+                        out("[ok]\n")
+                        out("\n%s" % data["result"]["output"])
                     break
                 elif data["state"] == "failed":
                     out("[failed]\n")
@@ -564,6 +1174,9 @@ def cmd_run(args, config):
                     out("[locked]\n")
                     out("\nYour execution failed due to being locked. This means there is another execution already in progress.\n")
                     sys.exit(1)
+                elif chunk:
+                    # poll sooner while the command is producing output
+                    time.sleep(0.5)
                 else:
                     time.sleep(2)
 
@@ -579,8 +1192,7 @@ def cmd_delete(args, config):
         error("unable to find a .gondor directory.\n")
     
     out("Reading configuration... ")
-    local_config = ConfigParser.RawConfigParser()
-    local_config.read(os.path.join(project_root, gondor_dirname, "config"))
+    local_config = utils.read_config(os.path.join(project_root, gondor_dirname, "config"))
     endpoint = config_value(local_config, "gondor", "endpoint", DEFAULT_ENDPOINT)
     site_key = local_config.get("gondor", "site_key")
     out("[ok]\n")
@@ -625,8 +1237,7 @@ def cmd_list(args, config):
         error("unable to find a .gondor directory.\n")
     
     out("Reading configuration... ")
-    local_config = ConfigParser.RawConfigParser()
-    local_config.read(os.path.join(project_root, gondor_dirname, "config"))
+    local_config = utils.read_config(os.path.join(project_root, gondor_dirname, "config"))
     endpoint = config_value(local_config, "gondor", "endpoint", DEFAULT_ENDPOINT)
     site_key = local_config.get("gondor", "site_key")
     out("[ok]\n")
@@ -635,29 +1246,42 @@ def cmd_list(args, config):
     params = {
         "version": __version__,
         "site_key": site_key,
+        # paginating APIs sort and trim the rows themselves; older ones
+        # ignore these and send every instance in one response
+        "order": "label",
+        "fields": ",".join(LIST_FIELDS),
+        "limit": LIST_PAGE_SIZE,
     }
-    try:
-        response = make_api_call(config, url, urllib.urlencode(params))
-    except urllib2.HTTPError, e:
-        out("\nReceived an error [%d: %s]" % (e.code, e.read()))
-        sys.exit(1)
-    data = json.loads(response.read())
-    
-    if data["status"] == "success":
-        out("\n")
-        instances = sorted(data["instances"], key=lambda v: v["label"])
-        if instances:
-            for instance in instances:
-                out("%s [%s] %s %s\n" % (
-                    instance["label"],
-                    instance["kind"],
-                    instance["url"],
-                    instance["last_deployment"]["sha"][:8]
-                ))
-        else:
-            out("No instances found.\n")
-    else:
-        error("%s\n" % data["message"])
+    found = False
+    while True:
+        try:
+            response = make_api_call(config, url, urllib.urlencode(params))
+        except urllib2.HTTPError, e:
+            out("\nReceived an error [%d: %s]" % (e.code, e.read()))
+            sys.exit(1)
+        data = json.loads(response.read())
+        if data["status"] != "success":
+            error("%s\n" % data["message"])
+        if "cursor" not in params:
+            out("\n")
+        paginated = "next" in data
+        instances = data["instances"]
+        if not paginated:
+            instances = sorted(instances, key=lambda v: v["label"])
+        for instance in instances:
+            found = True
+            last_deployment = instance.get("last_deployment") or {}
+            out("%s [%s] %s %s\n" % (
+                instance["label"],
+                instance["kind"],
+                instance["url"],
+                (last_deployment.get("sha") or "")[:8]
+            ))
+        if not paginated or not data["next"]:
+            break
+        params["cursor"] = data["next"]
+    if not found:
+        out("No instances found.\n")
 
 
 def cmd_manage(args, config):
@@ -673,8 +1297,7 @@ def cmd_manage(args, config):
         error("unable to find a .gondor directory.\n")
     
     out("Reading configuration... ")
-    local_config = ConfigParser.RawConfigParser()
-    local_config.read(os.path.join(project_root, gondor_dirname, "config"))
+    local_config = utils.read_config(os.path.join(project_root, gondor_dirname, "config"))
     endpoint = config_value(local_config, "gondor", "endpoint", DEFAULT_ENDPOINT)
     site_key = local_config.get("gondor", "site_key")
     out("[ok]\n")
@@ -691,12 +1314,8 @@ def cmd_manage(args, config):
     ]
     if not sys.stdin.isatty():
         params["stdin"] = sys.stdin
-        pb = ProgressBar(0, 100, 77)
         out("Pushing stdin to Gondor... \n")
-        handlers.extend([
-            http.UploadProgressHandler(pb, ssl=True),
-            http.UploadProgressHandler(pb, ssl=False)
-        ])
+        meter, handlers = upload_handlers(config, "upload")
     params = params.items()
     for oparg in opargs:
         params.append(("arg", oparg))
@@ -705,8 +1324,7 @@ def cmd_manage(args, config):
     except urllib2.HTTPError, e:
         out("\nReceived an error [%d: %s]" % (e.code, e.read()))
         sys.exit(1)
-    if not sys.stdin.isatty():
-        out("\n")
+    history.current().mark("upload")
     out("Running... ")
     data = json.loads(response.read())
     
@@ -722,15 +1340,18 @@ def cmd_manage(args, config):
                 "instance_label": instance_label,
                 "task_id": task_id,
             }
-            url = "%s/task_status/" % endpoint
-            response = make_api_call(config, url, urllib.urlencode(params))
-            data = json.loads(response.read())
+            try:
+                data = tasks.registry.status(config, endpoint, params)
+            except urllib2.URLError, e:
+                out("[error]\n")
+                error("unable to check status: %s\n" % e.reason)
             if data["status"] == "error":
                 out("[error]\n")
                 out("\nError: %s\n" % data["message"])
             if data["status"] == "success":
                 if data["state"] == "finished":
                     out("[ok]\n")
+                    history.current().mark("run")
                     break
                 elif data["state"] == "failed":
                     out("[failed]\n")
@@ -743,9 +1364,93 @@ def cmd_manage(args, config):
                 else:
                     time.sleep(2)
 
-def main():
+
+def cmd_batch(args, config):
+    if args.operations[0] == "-":
+        fp = sys.stdin
+    else:
+        try:
+            fp = open(args.operations[0])
+        except IOError, e:
+            error("%s\n" % e)
+    try:
+        operations = batch.parse_operations(fp, build_parser())
+    except ValueError, e:
+        error("%s\n" % e)
+    finally:
+        fp.close()
+    if args.concurrency < 1:
+        error("--concurrency must be at least 1\n")
+    failed = batch.Batch(operations, dispatch, config, args.concurrency).run()
+    if failed:
+        sys.exit(1)
+
+
+operations = history.History()
+
+
+def cmd_stats(args, config):
+    since = None
+    if args.days is not None:
+        since = time.time() - args.days * 86400
+    records = [
+        record for record in operations.records(since)
+        if (args.label is None or record["label"] == args.label)
+        and (args.recorded_command is None or record["command"] == args.recorded_command)
+    ]
+    summaries = history.summarize(records)
+    if args.prometheus is not None:
+        tmp = "%s.tmp" % args.prometheus
+        try:
+            with open(tmp, "w") as fp:
+                fp.write(history.prometheus(summaries))
+            # renamed into place so the collector never reads a partial file
+            os.rename(tmp, args.prometheus)
+        except (IOError, OSError), e:
+            error("unable to write %s: %s\n" % (args.prometheus, e))
+        return
+    if not summaries:
+        out("No operations recorded.\n")
+        return
+    def seconds(values):
+        return "  ".join("%7.1fs" % v for v in values)
+    out("%-24s %6s %6s  %8s  %8s  %8s  %8s\n" % ("", "runs", "failed", "p50", "p95", "p99", "trend"))
+    for summary in summaries:
+        if summary["quantiles"] is None:
+            quantiles = "%8s  %8s  %8s" % ("-", "-", "-")
+        else:
+            quantiles = seconds(summary["quantiles"])
+        if summary["trend"] is None:
+            trend = "-"
+        else:
+            trend = "%+.1fs" % summary["trend"]
+        out("%-24s %6d %6d  %s  %8s\n" % (
+            "%s %s" % (summary["command"], summary["label"]),
+            summary["count"],
+            summary["failures"],
+            quantiles,
+            trend
+        ))
+        for phase, values in sorted(summary["phases"].items()):
+            out("  %-36s  %s\n" % (phase, seconds(values)))
+        for name, values in sorted(summary["observed"].items()):
+            out("  %-36s  %s\n" % ("%s (mean)" % name, "  ".join("%6.0fms" % (v * 1000) for v in values)))
+
+
+def cmd_agent(args, config):
+    if args.socket is not None:
+        path = args.socket
+    else:
+        path = client.socket_path()
+    agent.Agent(path, run).serve()
+
+
+def build_parser():
     parser = argparse.ArgumentParser(prog="gondor")
     parser.add_argument("--version", action="version", version="%%(prog)s %s" % __version__)
+    parser.add_argument("--limit-rate", metavar="RATE",
+        help="cap transfer bandwidth in bytes per second (e.g. 500k, 2M)"
+    )
     
     command_parsers = parser.add_subparsers(dest="command")
     
@@ -760,11 +1465,40 @@ def main():
     
     # cmd: deploy
     parser_deploy = command_parsers.add_parser("deploy")
+    parser_deploy.add_argument("--compression", metavar="LEVEL",
+        help="gzip level 0-9 for the tarball, or auto to pick one from upload bandwidth (default 9)"
+    )
+    parser_deploy.add_argument("--queue", action="store_true",
+        help="wait for a deployment in progress instead of failing; only the newest queued commit is deployed"
+    )
+    parser_deploy.add_argument("--wheelhouse", action="store_true",
+        help="build wheels for the requirements file locally and upload the ones Gondor is missing"
+    )
+    parser_deploy.add_argument("--static-manifest", action="store_true",
+        help="upload only the static assets Gondor is missing (needs staticfiles = on)"
+    )
     parser_deploy.add_argument("label", nargs=1)
     parser_deploy.add_argument("commit", nargs=1)
     
+    # cmd: sync
+    # pushes changed files to a (dev) instance as they are saved
+    parser_sync = command_parsers.add_parser("sync")
+    parser_sync.add_argument("--debounce", type=float, default=0.5,
+        help="seconds without changes before pushing a batch (default 0.5)"
+    )
+    parser_sync.add_argument("label", nargs=1)
+    
     # cmd: sqldump
     parser_sqldump = command_parsers.add_parser("sqldump")
+    parser_sqldump.add_argument("--baseline", metavar="FILE",
+        help="previous plain SQL dump; only blocks which changed are downloaded"
+    )
+    parser_sqldump.add_argument("--output", metavar="FILE",
+        help="write the dump to FILE (replaced only once complete) instead of stdout"
+    )
+    parser_sqldump.add_argument("--raw", action="store_true",
+        help="with --output, keep the dump gzip compressed as Gondor serves it"
+    )
     parser_sqldump.add_argument("label", nargs=1)
     
     # cmd: run
@@ -788,26 +1522,86 @@ def main():
     parser_manage.add_argument("operation", nargs=1)
     parser_manage.add_argument("opargs", nargs="*")
     
-    args = parser.parse_args()
+    # cmd: batch
+    # runs operations listed one JSON object per line, for example:
+    # {"op": "run", "args": ["primary", "migrate"]}
+    parser_batch = command_parsers.add_parser("batch")
+    parser_batch.add_argument("--concurrency", type=int, default=4)
+    parser_batch.add_argument("operations", nargs=1)
+    
+    # cmd: stats
+    # summarizes recorded deploy/sqldump/manage timings
+    parser_stats = command_parsers.add_parser("stats")
+    parser_stats.add_argument("--label")
+    # dest differs from the flag as args.command names the subcommand
+    parser_stats.add_argument("--command", dest="recorded_command", choices=sorted(history.RECORDED))
+    parser_stats.add_argument("--days", type=float,
+        help="only include operations from the last DAYS days"
+    )
+    parser_stats.add_argument("--prometheus", metavar="FILE",
+        help="write metrics to FILE in Prometheus text format instead of printing them"
+    )
     
-    # config
+    # cmd: agent
+    # runs in the foreground; gondor commands are forwarded to it while it
+    # is listening
+    parser_agent = command_parsers.add_parser("agent")
+    parser_agent.add_argument("--socket")
     
-    config = ConfigParser.RawConfigParser()
-    config.read(os.path.expanduser("~/.gondor"))
+    return parser
+
+
+def load_config(args):
+    config = utils.read_config(os.path.expanduser("~/.gondor"))
     config = {
         "username": config_value(config, "auth", "username"),
         "password": config_value(config, "auth", "password"),
+        "limit_rate": config_value(config, "transfer", "limit_rate"),
+        "compression": config_value(config, "transfer", "compression"),
+        "http2": config_value(config, "api", "http2", "off") == "on",
     }
     if config["username"] is None or config["password"] is None:
         error("you must set your credentials in ~/.gondor correctly\n")
-    
-    {
+    if args.limit_rate is not None:
+        config["limit_rate"] = args.limit_rate
+    if getattr(args, "compression", None) is not None:
+        config["compression"] = args.compression
+    try:
+        config["limit_rate"] = throttle.parse_rate(config["limit_rate"])
+        config["compression"] = compression.parse_level(config["compression"])
+    except ValueError, e:
+        error("%s\n" % e)
+    if config["http2"] and http2.h2 is None:
+        error("http2 = on in ~/.gondor requires the h2 package (pip install h2)\n")
+    return config
+
+
+def dispatch(args, config):
+    func = {
         "init": cmd_init,
         "create": cmd_create,
         "deploy": cmd_deploy,
         "sqldump": cmd_sqldump,
+        "sync": cmd_sync,
         "run": cmd_run,
         "delete": cmd_delete,
         "list": cmd_list,
         "manage": cmd_manage,
-    }[args.command](args, config)
+        "batch": cmd_batch,
+        "agent": cmd_agent,
+        "stats": cmd_stats,
+    }[args.command]
+    if args.command in history.RECORDED:
+        with operations.recording(args.command, args.label[0]):
+            func(args, config)
+    else:
+        func(args, config)
+
+
+def run(argv=None):
+    args = build_parser().parse_args(argv)
+    dispatch(args, load_config(args))
+
+
+def main():
+    run()
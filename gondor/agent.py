@@ -0,0 +1,174 @@
+"""
+The gondor agent is an opt-in resident process which runs commands forwarded
+by gondor.client. It keeps the interpreter, imported modules, parsed config
+and keep-alive API connections warm between invocations. VCS lookups are
+not cached; each command finds its repository afresh since the working tree
+may change between commands.
+"""
+
+import os
+import signal
+import socket
+import sys
+import threading
+import traceback
+
+from gondor import client, utils
+
+
+class FrameWriter(object):
+    """
+    File-like object that relays writes to a connected client as frames.
+    """
+    
+    def __init__(self, sock, kind, lock, tty=False):
+        self.sock = sock
+        self.kind = kind
+        self.lock = lock
+        self.tty = tty
+    
+    def write(self, data):
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        with self.lock:
+            client.send_frame(self.sock, self.kind, data)
+    
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+    
+    def flush(self):
+        pass
+    
+    def isatty(self):
+        return self.tty
+
+
+class WorkingDirectory(object):
+    """
+    Commands rely on the process working directory. Commands sharing a
+    directory run concurrently; a command in another directory waits until
+    the current ones finish.
+    """
+    
+    def __init__(self):
+        self.cond = threading.Condition()
+        self.cwd = None
+        self.users = 0
+    
+    def enter(self, cwd):
+        with self.cond:
+            while self.users and self.cwd != cwd:
+                self.cond.wait()
+            if not self.users:
+                os.chdir(cwd)
+                self.cwd = cwd
+            self.users += 1
+    
+    def leave(self):
+        with self.cond:
+            self.users -= 1
+            if not self.users:
+                self.cond.notify_all()
+
+
+class Agent(object):
+    
+    def __init__(self, path, run):
+        self.path = path
+        self.run = run
+        self.cwd = WorkingDirectory()
+        self.stdout = utils.ThreadLocalStream(sys.stdout)
+        self.stderr = utils.ThreadLocalStream(sys.stderr)
+        self.stdin = utils.ThreadLocalStream(sys.stdin)
+    
+    def read_request(self, sock):
+        request = {"argv": []}
+        while True:
+            kind, payload = client.recv_frame(sock)
+            if kind == "c":
+                request["cwd"] = payload
+            elif kind == "t":
+                request["tty"] = [c == "1" for c in payload]
+            elif kind == "a":
+                request["argv"].append(payload)
+            elif kind == "r":
+                return request
+    
+    def handle(self, sock):
+        try:
+            request = self.read_request(sock)
+        except EOFError:
+            sock.close()
+            return
+        lock = threading.Lock()
+        stdin_tty, stdout_tty, stderr_tty = request["tty"]
+        self.stdout.redirect(FrameWriter(sock, "o", lock, tty=stdout_tty))
+        self.stderr.redirect(FrameWriter(sock, "e", lock, tty=stderr_tty))
+        self.stdin.redirect(utils.NullInput(tty=stdin_tty))
+        self.cwd.enter(request["cwd"])
+        code = 0
+        try:
+            self.run(request["argv"])
+        except SystemExit, e:
+            if e.code is None:
+                code = 0
+            elif isinstance(e.code, int):
+                code = e.code
+            else:
+                sys.stderr.write("%s\n" % e.code)
+                code = 1
+        except socket.error:
+            # the client went away (most likely ^C); abandon the command
+            code = None
+        except Exception:
+            sys.stderr.write(traceback.format_exc())
+            code = 1
+        finally:
+            self.cwd.leave()
+            self.stdout.redirect(None)
+            self.stderr.redirect(None)
+            self.stdin.redirect(None)
+        try:
+            if code is not None:
+                client.send_frame(sock, "x", str(code))
+        except socket.error:
+            pass
+        finally:
+            sock.close()
+    
+    def serve(self):
+        if os.path.exists(self.path):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.path)
+            except socket.error:
+                os.unlink(self.path)
+            else:
+                utils.error("an agent is already listening on %s\n" % self.path)
+            finally:
+                probe.close()
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(32)
+        sys.stdout, sys.stderr, sys.stdin = self.stdout, self.stderr, self.stdin
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        utils.err("gondor agent listening on %s\n" % self.path)
+        try:
+            while True:
+                sock = listener.accept()[0]
+                t = threading.Thread(target=self.handle, args=(sock,))
+                t.daemon = True
+                t.start()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            os.unlink(self.path)
+            sys.stdout = self.stdout.default
+            sys.stderr = self.stderr.default
+            sys.stdin = self.stdin.default
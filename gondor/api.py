@@ -1,13 +1,110 @@
 import base64
+import errno
+import httplib
+import random
+import socket
+import threading
+import time
 import urllib2
+import urlparse
+import uuid
 
-from gondor import http
+from gondor import http, http2
+
+
+# shared by every API call in the process so connections stay warm between
+# calls (and between commands when running inside the agent)
+pool = http.ConnectionPool()
+h2_transports = http2.TransportPool()
+
+RETRYABLE_STATUS = set([429, 502, 503, 504])
+RETRYABLE_ERRNO = set([
+    errno.ECONNREFUSED,
+    errno.ECONNRESET,
+    errno.ECONNABORTED,
+    errno.EHOSTUNREACH,
+    errno.ENETUNREACH,
+    errno.ETIMEDOUT,
+    errno.EPIPE,
+])
+
+
+class CircuitOpenError(urllib2.URLError):
+    """
+    Raised without contacting the API when recent calls to the same host
+    have all failed. Subclasses URLError so existing handlers catch it.
+    """
+
+
+class RetryPolicy(object):
+    """
+    Retries transient failures with exponential backoff and full jitter.
+    After breaker_threshold consecutive calls to a host have exhausted their
+    retries, further calls to that host fail fast for breaker_cooldown
+    seconds; the first call after the cooldown is let through as a probe.
+    """
+    
+    def __init__(self, attempts=5, backoff=0.5, max_backoff=30,
+                 breaker_threshold=3, breaker_cooldown=30):
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_cooldown = breaker_cooldown
+        self.failures = {}
+        self.opened = {}
+        self.lock = threading.Lock()
+    
+    def retryable(self, exc):
+        if isinstance(exc, CircuitOpenError):
+            return False
+        if isinstance(exc, urllib2.HTTPError):
+            return exc.code in RETRYABLE_STATUS
+        if isinstance(exc, urllib2.URLError):
+            exc = exc.reason
+        if isinstance(exc, (socket.timeout, httplib.HTTPException)):
+            return True
+        if isinstance(exc, socket.error):
+            return exc.errno in RETRYABLE_ERRNO
+        return False
+    
+    def delay(self, attempt):
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+    
+    def check_circuit(self, host):
+        with self.lock:
+            opened = self.opened.get(host)
+            if opened is None:
+                return
+            if time.time() - opened < self.breaker_cooldown:
+                raise CircuitOpenError(
+                    "too many failed requests to %s; not retrying for %d seconds" % (
+                        host, self.breaker_cooldown
+                    )
+                )
+            # half-open: let this call through as a probe
+            del self.opened[host]
+    
+    def record(self, host, success):
+        with self.lock:
+            if success:
+                self.failures.pop(host, None)
+                return
+            self.failures[host] = self.failures.get(host, 0) + 1
+            if self.failures[host] >= self.breaker_threshold:
+                self.opened[host] = time.time()
+
+
+policy = RetryPolicy()
 
 
 def make_api_call(config, url, params, extra_handlers=None):
     handlers = [
-        http.HTTPSHandler,
+        http.PooledHTTPSHandler(pool),
+        http.PooledHTTPHandler(pool),
     ]
+    if config.get("http2"):
+        handlers.append(http2.HTTP2Handler(h2_transports))
     if extra_handlers is not None:
         handlers.extend(extra_handlers)
     opener = urllib2.build_opener(*handlers)
@@ -19,4 +116,31 @@ def make_api_call(config, url, params, extra_handlers=None):
             config["password"])
         ).strip()
     )
-    return opener.open(request)
+    # the same key is sent on every attempt so the API can tell a retried
+    # create/deploy/run apart from a new one
+    request.add_unredirected_header("Idempotency-Key", uuid.uuid4().hex)
+    host = urlparse.urlparse(url).netloc
+    policy.check_circuit(host)
+    attempt = 0
+    while True:
+        # the request is reused as is: handlers encode the body on the
+        # first attempt only, and an encoded body read by a failed attempt
+        # has to start over
+        if hasattr(request.data, "seek"):
+            request.data.seek(0)
+        try:
+            response = opener.open(request)
+        except (urllib2.URLError, httplib.HTTPException, socket.error), e:
+            attempt += 1
+            retryable = policy.retryable(e)
+            if retryable and attempt < policy.attempts:
+                time.sleep(policy.delay(attempt))
+                continue
+            # an HTTP error the API chose to send is an answer, not an outage
+            policy.record(host, success=isinstance(e, urllib2.HTTPError) and not retryable)
+            if not isinstance(e, urllib2.URLError):
+                raise urllib2.URLError(e)
+            raise
+        else:
+            policy.record(host, success=True)
+            return response
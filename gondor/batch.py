@@ -0,0 +1,194 @@
+"""
+Runs many gondor operations from one process. Operations for the same
+instance run in the order given; operations for different instances run
+concurrently up to a limit. All of them share the API connection pool.
+"""
+
+import sys
+import threading
+import time
+import traceback
+
+from cStringIO import StringIO
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from gondor import utils
+
+
+OPERATIONS = set(["create", "deploy", "run", "manage", "delete"])
+
+
+class Operation(object):
+    
+    def __init__(self, lineno, spec, args):
+        self.lineno = lineno
+        self.spec = spec
+        self.args = args
+        label = getattr(args, "label", None) or getattr(args, "instance_label")
+        self.label = label[0]
+
+
+class Scheduler(object):
+    """
+    Hands out operations in file order, skipping any whose instance already
+    has an operation running.
+    """
+    
+    def __init__(self, operations):
+        self.pending = list(operations)
+        self.busy = set()
+        self.cond = threading.Condition()
+    
+    def next(self):
+        with self.cond:
+            while self.pending:
+                for idx, operation in enumerate(self.pending):
+                    if operation.label not in self.busy:
+                        self.busy.add(operation.label)
+                        return self.pending.pop(idx)
+                self.cond.wait()
+            return None
+    
+    def done(self, operation):
+        with self.cond:
+            self.busy.discard(operation.label)
+            self.cond.notify_all()
+
+
+def parse_operations(fp, parser):
+    """
+    Reads one JSON object per line, e.g.:
+        
+        {"op": "run", "args": ["primary", "migrate"], "id": "migrate-primary"}
+    
+    Blank lines and lines starting with # are skipped. Raises ValueError
+    naming the offending line for anything that would not run.
+    """
+    operations = []
+    for lineno, line in enumerate(fp, 1):
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+        try:
+            spec = json.loads(line)
+        except ValueError, e:
+            raise ValueError("line %d: %s" % (lineno, e))
+        if not isinstance(spec, dict):
+            raise ValueError("line %d: not a JSON object" % lineno)
+        if spec.get("op") not in OPERATIONS:
+            raise ValueError("line %d: op must be one of %s" % (
+                lineno, ", ".join(sorted(OPERATIONS))
+            ))
+        if not isinstance(spec.get("args", []), list):
+            raise ValueError("line %d: args must be a list" % lineno)
+        argv = [spec["op"]] + [str(arg) for arg in spec.get("args", [])]
+        # argparse prints usage errors to stderr and --help to stdout
+        stdout, stderr = sys.stdout, sys.stderr
+        sys.stdout, sys.stderr = StringIO(), StringIO()
+        try:
+            args = parser.parse_args(argv)
+        except SystemExit:
+            messages = sys.stderr.getvalue().strip().splitlines()
+            if messages:
+                raise ValueError("line %d: %s" % (lineno, messages[-1]))
+            raise ValueError("line %d: invalid arguments" % lineno)
+        finally:
+            sys.stdout, sys.stderr = stdout, stderr
+        operations.append(Operation(lineno, spec, args))
+    return operations
+
+
+class Batch(object):
+    
+    def __init__(self, operations, dispatch, config, concurrency=4, results=None):
+        self.scheduler = Scheduler(operations)
+        self.dispatch = dispatch
+        self.config = config
+        self.concurrency = concurrency
+        if results is None:
+            results = sys.stdout
+        self.results = results
+        self.results_lock = threading.Lock()
+        self.failed = 0
+    
+    def execute(self, operation):
+        stdout, stderr = StringIO(), StringIO()
+        sys.stdout.redirect(stdout)
+        sys.stderr.redirect(stderr)
+        if operation.spec["op"] == "delete":
+            # listing the delete in the operations file is the confirmation
+            sys.stdin.redirect(StringIO("Y\n"))
+        else:
+            # claim a terminal so manage does not try to upload stdin
+            sys.stdin.redirect(utils.NullInput(tty=True))
+        start = time.time()
+        try:
+            self.dispatch(operation.args, self.config)
+        except SystemExit, e:
+            code = e.code or 0
+            if not isinstance(code, int):
+                stderr.write("%s\n" % code)
+                code = 1
+        except Exception:
+            stderr.write(traceback.format_exc())
+            code = 1
+        else:
+            code = 0
+        finally:
+            sys.stdout.redirect(None)
+            sys.stderr.redirect(None)
+            sys.stdin.redirect(None)
+        result = {
+            "line": operation.lineno,
+            "op": operation.spec["op"],
+            "label": operation.label,
+            "exit": code,
+            "duration": round(time.time() - start, 3),
+            "output": stdout.getvalue(),
+            "error": stderr.getvalue(),
+        }
+        if "id" in operation.spec:
+            result["id"] = operation.spec["id"]
+        return result
+    
+    def worker(self):
+        while True:
+            operation = self.scheduler.next()
+            if operation is None:
+                return
+            try:
+                result = self.execute(operation)
+            finally:
+                self.scheduler.done(operation)
+            with self.results_lock:
+                if result["exit"] != 0:
+                    self.failed += 1
+                self.results.write(json.dumps(result) + "\n")
+                self.results.flush()
+    
+    def run(self):
+        """
+        Runs every operation and returns the number that failed.
+        """
+        streams = sys.stdout, sys.stderr, sys.stdin
+        sys.stdout = utils.ThreadLocalStream(sys.stdout)
+        sys.stderr = utils.ThreadLocalStream(sys.stderr)
+        sys.stdin = utils.ThreadLocalStream(sys.stdin)
+        try:
+            threads = []
+            for idx in xrange(self.concurrency):
+                t = threading.Thread(target=self.worker)
+                t.daemon = True
+                t.start()
+                threads.append(t)
+            for t in threads:
+                # join with a timeout so ^C still reaches the main thread
+                while t.is_alive():
+                    t.join(0.5)
+        finally:
+            sys.stdout, sys.stderr, sys.stdin = streams
+        return self.failed
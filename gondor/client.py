@@ -0,0 +1,108 @@
+"""
+Thin command line entry point. When a gondor agent is listening on its Unix
+socket the command is forwarded to it; otherwise the command runs in-process
+as usual. This module is kept to a handful of cheap imports since avoiding
+startup work is the whole point of forwarding.
+"""
+
+import os
+import socket
+import struct
+import sys
+
+
+HEADER = struct.Struct("!cI")
+
+# commands which prompt, read stdin, run until interrupted or juggle their own
+# output streams always run in-process
+LOCAL_ONLY = set(["agent", "batch", "delete", "createsuperuser", "sync"])
+
+
+def socket_path():
+    return os.environ.get(
+        "GONDOR_AGENT_SOCKET",
+        os.path.expanduser("~/.gondor-agent.sock")
+    )
+
+
+def send_frame(sock, kind, payload=""):
+    sock.sendall(HEADER.pack(kind, len(payload)) + payload)
+
+
+def _recv_exactly(sock, size):
+    chunks = []
+    while size:
+        chunk = sock.recv(size)
+        if not chunk:
+            raise EOFError
+        chunks.append(chunk)
+        size -= len(chunk)
+    return "".join(chunks)
+
+
+def recv_frame(sock):
+    kind, size = HEADER.unpack(_recv_exactly(sock, HEADER.size))
+    return kind, _recv_exactly(sock, size)
+
+
+def forwardable(argv):
+    if os.environ.get("GONDOR_NO_AGENT"):
+        return False
+    if LOCAL_ONLY.intersection(argv):
+        return False
+    if "manage" in argv and not sys.stdin.isatty():
+        return False
+    return True
+
+
+def forward(argv, path=None):
+    """
+    Runs argv on the agent, relaying its output. Returns the exit code or None
+    when no agent is reachable.
+    """
+    if path is None:
+        path = socket_path()
+    if not os.path.exists(path):
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(path)
+    except socket.error:
+        sock.close()
+        return None
+    try:
+        send_frame(sock, "c", os.getcwd())
+        send_frame(sock, "t", "%d%d%d" % (
+            sys.stdin.isatty(),
+            sys.stdout.isatty(),
+            sys.stderr.isatty(),
+        ))
+        for arg in argv:
+            send_frame(sock, "a", arg)
+        send_frame(sock, "r")
+        streams = {"o": sys.stdout, "e": sys.stderr}
+        while True:
+            kind, payload = recv_frame(sock)
+            if kind == "x":
+                return int(payload)
+            streams[kind].write(payload)
+            streams[kind].flush()
+    except EOFError:
+        sys.stderr.write("ERROR: lost connection to gondor agent\n")
+        return 1
+    except KeyboardInterrupt:
+        # closing the socket tells the agent to abandon the command
+        sys.stderr.write("\n")
+        return 1
+    finally:
+        sock.close()
+
+
+def main():
+    argv = sys.argv[1:]
+    if forwardable(argv):
+        code = forward(argv)
+        if code is not None:
+            sys.exit(code)
+    from gondor.__main__ import main as run_local
+    run_local()
@@ -0,0 +1,274 @@
+"""
+Picks the gzip level for deploy tarballs. Compressibility and compression
+speed are measured on samples of the tar; upload bandwidth comes from the
+history of previous uploads to the same endpoint. The level which minimizes
+compress time plus upload time wins.
+
+Tar members which are already compressed (images, fonts, archives, wheels)
+are stored rather than deflated. The tarball is written as a sequence of
+gzip members, which gunzip and tarfile read back as one stream, so the
+server still receives a plain .tar.gz.
+"""
+
+import gzip
+import math
+import os
+import tarfile
+import threading
+import time
+import zlib
+
+from contextlib import closing
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+LEVELS = [0, 1, 3, 6, 9]
+DEFAULT_LEVEL = 9 # what gzip.open uses
+SAMPLES = 8
+SAMPLE_SIZE = 256 * 1024
+# uploads smaller than this finish too quickly to say much about bandwidth
+MIN_RECORDED_UPLOAD = 256 * 1024
+
+INCOMPRESSIBLE_SUFFIXES = (
+    ".png", ".jpg", ".jpeg", ".gif", ".webp", ".ico",
+    ".woff", ".woff2", ".eot",
+    ".zip", ".whl", ".egg", ".jar", ".gz", ".tgz", ".bz2", ".xz", ".7z",
+    ".mp3", ".mp4", ".ogg", ".webm", ".pdf",
+)
+# smaller members are not worth starting a new gzip member for
+MIN_STORED_MEMBER = 16 * 1024
+ENTROPY_SAMPLE = 16 * 1024
+# bits per byte above which deflate has next to nothing to gain
+ENTROPY_THRESHOLD = 7.5
+
+
+def parse_level(value):
+    """
+    Accepts "auto" or a gzip level from 0 to 9. Returns "auto" or an int.
+    """
+    if value is None:
+        return DEFAULT_LEVEL
+    if value == "auto":
+        return value
+    try:
+        level = int(value)
+    except ValueError:
+        level = -1
+    if not 0 <= level <= 9:
+        raise ValueError("invalid compression '%s' (use auto or 0-9)" % value)
+    return level
+
+
+def read_samples(path, ranges):
+    """
+    Reads up to SAMPLES evenly spread samples from the (start, end) byte
+    ranges of the file at path, treated as one contiguous stream.
+    """
+    size = sum(end - start for start, end in ranges)
+    if size <= SAMPLES * SAMPLE_SIZE:
+        offsets = [0]
+        length = size
+    else:
+        step = (size - SAMPLE_SIZE) // (SAMPLES - 1)
+        offsets = [idx * step for idx in xrange(SAMPLES)]
+        length = SAMPLE_SIZE
+    samples = []
+    with open(path, "rb") as fp:
+        for offset in offsets:
+            sample = []
+            remaining = length
+            for start, end in ranges:
+                if offset >= end - start:
+                    offset -= end - start
+                    continue
+                fp.seek(start + offset)
+                data = fp.read(min(remaining, end - start - offset))
+                sample.append(data)
+                remaining -= len(data)
+                offset = 0
+                if not remaining:
+                    break
+            samples.append("".join(sample))
+    return samples
+
+
+def measure(path, ranges):
+    """
+    Returns {level: (ratio, seconds per input byte)} measured on samples of
+    the given ranges of the file at path.
+    """
+    samples = read_samples(path, ranges)
+    sampled = float(sum(len(s) for s in samples)) or 1.0
+    results = {}
+    for level in LEVELS:
+        compressed = 0
+        start = time.time()
+        for s in samples:
+            c = zlib.compressobj(level)
+            compressed += len(c.compress(s)) + len(c.flush())
+        elapsed = time.time() - start
+        results[level] = (compressed / sampled, elapsed / sampled)
+    return results
+
+
+def choose_level(path, bandwidth, ranges=None):
+    """
+    Returns (level, predicted compress seconds, predicted upload seconds) for
+    uploading the tar at path at bandwidth bytes per second. Stored ranges
+    (see plan) are uploaded as is whatever the level.
+    """
+    if ranges is None:
+        ranges = plan(path)
+    compressed = [(start, end) for start, end, stored in ranges if not stored]
+    size = sum(end - start for start, end in compressed)
+    stored_size = sum(end - start for start, end, stored in ranges if stored)
+    best = None
+    for level, (ratio, spb) in sorted(measure(path, compressed).items()):
+        compress_time = size * spb
+        upload_time = (size * ratio + stored_size) / bandwidth
+        if best is None or compress_time + upload_time < best[1] + best[2]:
+            best = (level, compress_time, upload_time)
+    return best
+
+
+def entropy(data):
+    """
+    Returns the Shannon entropy of data in bits per byte.
+    """
+    if not data:
+        return 0.0
+    counts = {}
+    for byte in data:
+        counts[byte] = counts.get(byte, 0) + 1
+    size = float(len(data))
+    return -sum(
+        count / size * math.log(count / size, 2)
+        for count in counts.itervalues()
+    )
+
+
+def incompressible(member, fp):
+    if member.name.lower().endswith(INCOMPRESSIBLE_SUFFIXES):
+        return True
+    # sample from the middle, past any header the format might have
+    fp.seek(member.offset_data + max(member.size - ENTROPY_SAMPLE, 0) // 2)
+    return entropy(fp.read(min(member.size, ENTROPY_SAMPLE))) > ENTROPY_THRESHOLD
+
+
+def plan(tar_path):
+    """
+    Splits the tar at tar_path into [start, end, stored] byte ranges, where
+    stored ranges hold the data of incompressible members.
+    """
+    size = os.path.getsize(tar_path)
+    ranges = []
+    def add(start, end, stored):
+        if start >= end:
+            return
+        if ranges and ranges[-1][2] == stored:
+            ranges[-1][1] = end
+        else:
+            ranges.append([start, end, stored])
+    cursor = 0
+    with open(tar_path, "rb") as fp:
+        with closing(tarfile.open(tar_path)) as tar:
+            for member in tar:
+                if not member.isfile() or member.size < MIN_STORED_MEMBER:
+                    continue
+                if not incompressible(member, fp):
+                    continue
+                header = member.offset_data - cursor
+                if ranges and ranges[-1][2] and header <= tarfile.BLOCKSIZE * 4:
+                    # a lone header between two stored members is cheaper
+                    # stored than as a gzip member of its own
+                    add(cursor, member.offset_data, True)
+                else:
+                    add(cursor, member.offset_data, False)
+                # data is padded to a whole block
+                end = member.offset_data + member.size
+                end += -member.size % tarfile.BLOCKSIZE
+                add(member.offset_data, end, True)
+                cursor = end
+    add(cursor, size, False)
+    return ranges
+
+
+def write_tarball(tar_path, tarball_path, level, ranges=None, blocksize=64 * 1024):
+    """
+    Gzips the tar at tar_path to tarball_path, storing incompressible
+    members at level 0 and everything else at level. Returns the number of
+    bytes stored uncompressed.
+    """
+    if ranges is None:
+        ranges = plan(tar_path)
+    stored = 0
+    with open(tar_path, "rb") as src:
+        with open(tarball_path, "wb") as dst:
+            for start, end, raw in ranges:
+                if raw:
+                    stored += end - start
+                member = gzip.GzipFile(
+                    filename="",
+                    mode="wb",
+                    compresslevel=0 if raw else level,
+                    fileobj=dst
+                )
+                try:
+                    src.seek(start)
+                    remaining = end - start
+                    while remaining:
+                        chunk = src.read(min(blocksize, remaining))
+                        if not chunk:
+                            break
+                        member.write(chunk)
+                        remaining -= len(chunk)
+                finally:
+                    member.close()
+    return stored
+
+
+class BandwidthHistory(object):
+    """
+    Exponentially weighted upload rate per endpoint, kept in a small JSON
+    file between runs.
+    """
+    
+    def __init__(self, path=None, alpha=0.3):
+        if path is None:
+            path = os.path.expanduser("~/.gondor-bandwidth")
+        self.path = path
+        self.alpha = alpha
+        self.lock = threading.Lock()
+    
+    def load(self):
+        try:
+            with open(self.path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError):
+            return {}
+    
+    def get(self, endpoint):
+        return self.load().get(endpoint)
+    
+    def record(self, endpoint, transferred, elapsed):
+        if transferred < MIN_RECORDED_UPLOAD or elapsed <= 0:
+            return
+        rate = transferred / elapsed
+        with self.lock:
+            rates = self.load()
+            previous = rates.get(endpoint)
+            if previous is not None:
+                rate = self.alpha * rate + (1 - self.alpha) * previous
+            rates[endpoint] = rate
+            tmp = "%s.tmp" % self.path
+            try:
+                with open(tmp, "w") as fp:
+                    json.dump(rates, fp)
+                os.rename(tmp, self.path)
+            except (IOError, OSError):
+                # a missing estimate only costs us the auto choice next time
+                pass
@@ -0,0 +1,151 @@
+"""
+Differential sqldump refreshes (gondor sqldump --baseline), in the style of
+rsync. The baseline (a previous plain SQL dump) is cut into fixed size
+blocks and a signature holding each block's adler32 and md5 is sent with the
+dump request. The server rolls the adler32 over the new dump to find blocks
+the baseline already has and returns a delta: copies of baseline blocks and
+literal data for everything else. The client rebuilds the dump from the
+baseline and the delta and checks it against the sha256 of the full dump.
+
+Signature (gzip compressed): "GSIG", block size and block count as unsigned
+32-bit big-endian integers, then per block the adler32 (unsigned 32-bit) and
+the 16 byte md5 digest.
+
+Delta (gzip compressed): a sequence of operations ending with "E".
+    "C" first block, block count    copy blocks from the baseline
+    "L" length, data                literal data
+"""
+
+import gzip
+import hashlib
+import math
+import os
+import struct
+import zlib
+
+
+SIGNATURE_MAGIC = "GSIG"
+SIGNATURE_HEADER = struct.Struct(">4sII")
+SIGNATURE_RECORD = struct.Struct(">I16s")
+COPY = struct.Struct(">II")
+LITERAL = struct.Struct(">I")
+MIN_BLOCK_SIZE = 2 * 1024
+MAX_BLOCK_SIZE = 128 * 1024
+
+
+class DeltaError(Exception):
+    pass
+
+
+def block_size(size):
+    """
+    Picks a block size of about the square root of the baseline size (as
+    rsync does), rounded to a KiB: small enough that a change costs little
+    to resend, large enough that the signature stays small.
+    """
+    bs = int(math.sqrt(size)) // 1024 * 1024
+    return min(max(bs, MIN_BLOCK_SIZE), MAX_BLOCK_SIZE)
+
+
+def write_signature(baseline_path, signature_path):
+    """
+    Writes the signature of the file at baseline_path. Returns the block
+    size and block count.
+    """
+    bs = block_size(os.path.getsize(baseline_path))
+    records = []
+    with open(baseline_path, "rb") as fp:
+        while True:
+            block = fp.read(bs)
+            if not block:
+                break
+            records.append(SIGNATURE_RECORD.pack(
+                zlib.adler32(block) & 0xffffffff,
+                hashlib.md5(block).digest()
+            ))
+    sig = gzip.open(signature_path, "wb", 6)
+    try:
+        sig.write(SIGNATURE_HEADER.pack(SIGNATURE_MAGIC, bs, len(records)))
+        sig.write("".join(records))
+    finally:
+        sig.close()
+    return bs, len(records)
+
+
+class DeltaReader(object):
+    """
+    Reads exact amounts of decompressed data from a gzip compressed delta,
+    reporting compressed bytes to meter and bucket as they arrive.
+    """
+    
+    def __init__(self, fp, meter=None, bucket=None, chunk_size=16 * 1024):
+        self.fp = fp
+        self.meter = meter
+        self.bucket = bucket
+        self.chunk_size = chunk_size
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.buffer = ""
+        self.eof = False
+    
+    def fill(self, n):
+        while len(self.buffer) < n and not self.eof:
+            chunk = self.fp.read(self.chunk_size)
+            if not chunk:
+                self.buffer += self.decompressor.flush()
+                self.eof = True
+                break
+            if self.bucket is not None:
+                self.bucket.consume(len(chunk))
+            if self.meter is not None:
+                self.meter.add(len(chunk))
+            self.buffer += self.decompressor.decompress(chunk)
+    
+    def read(self, n):
+        self.fill(n)
+        if len(self.buffer) < n:
+            raise DeltaError("delta ended unexpectedly")
+        data, self.buffer = self.buffer[:n], self.buffer[n:]
+        return data
+
+
+def apply(reader, baseline_path, block_size, out_fp, chunk_size=64 * 1024):
+    """
+    Rebuilds the new dump from the baseline and the delta read by reader,
+    writing it to out_fp. Returns the sha256 hex digest and size of what was
+    written.
+    """
+    sha = hashlib.sha256()
+    size = 0
+    baseline_size = os.path.getsize(baseline_path)
+    with open(baseline_path, "rb") as baseline:
+        while True:
+            op = reader.read(1)
+            if op == "E":
+                break
+            if op == "C":
+                first, count = COPY.unpack(reader.read(COPY.size))
+                offset = first * block_size
+                end = min((first + count) * block_size, baseline_size)
+                if count == 0 or offset >= end:
+                    raise DeltaError("delta refers past the end of the baseline")
+                baseline.seek(offset)
+                remaining = end - offset
+                while remaining:
+                    data = baseline.read(min(chunk_size, remaining))
+                    if not data:
+                        raise DeltaError("baseline changed while rebuilding the dump")
+                    remaining -= len(data)
+                    sha.update(data)
+                    out_fp.write(data)
+                    size += len(data)
+            elif op == "L":
+                remaining = LITERAL.unpack(reader.read(LITERAL.size))[0]
+                while remaining:
+                    data = reader.read(min(chunk_size, remaining))
+                    remaining -= len(data)
+                    sha.update(data)
+                    out_fp.write(data)
+                    size += len(data)
+            else:
+                raise DeltaError("unknown delta operation %r" % op)
+    return sha.hexdigest(), size
@@ -0,0 +1,99 @@
+"""
+Local queue of waiting deploys, used by gondor deploy --queue. Each deploy
+of an instance takes a ticket in a small JSON file shared by every gondor
+process on the machine. A deploy goes ahead once every older ticket is gone;
+a deploy which sees a newer ticket is superseded and gives up, so only the
+newest commit waiting for an instance is deployed.
+"""
+
+import errno
+import hashlib
+import os
+import time
+
+try:
+    import fcntl
+except ImportError:
+    # no locking on platforms without fcntl
+    fcntl = None
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+def alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError, e:
+        return e.errno == errno.EPERM
+    return True
+
+
+class DeployQueue(object):
+    
+    def __init__(self, endpoint, site_key, label, root=None):
+        if root is None:
+            root = os.path.expanduser("~/.gondor-queue")
+        key = hashlib.sha1("%s\0%s\0%s" % (endpoint, site_key, label)).hexdigest()
+        self.root = root
+        self.path = os.path.join(root, "%s.json" % key)
+    
+    def update(self, func):
+        """
+        Calls func with the queue's tickets under an exclusive lock, saving
+        any changes it makes. Tickets of processes which have died are
+        dropped first.
+        """
+        if not os.path.exists(self.root):
+            try:
+                os.makedirs(self.root)
+            except OSError, e:
+                if e.errno != errno.EEXIST:
+                    raise
+        with open("%s.lock" % self.path, "a") as lock:
+            if fcntl is not None:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+            try:
+                with open(self.path) as fp:
+                    state = json.load(fp)
+            except (IOError, ValueError):
+                state = {"next": 1, "tickets": {}}
+            state["tickets"] = dict(
+                (ticket, entry) for ticket, entry in state["tickets"].iteritems()
+                if alive(entry["pid"])
+            )
+            result = func(state)
+            tmp = "%s.tmp" % self.path
+            with open(tmp, "w") as fp:
+                json.dump(state, fp)
+            os.rename(tmp, self.path)
+            return result
+    
+    def add(self, sha):
+        def add(state):
+            ticket = state["next"]
+            state["next"] += 1
+            state["tickets"][str(ticket)] = {
+                "sha": sha,
+                "pid": os.getpid(),
+                "time": time.time(),
+            }
+            return ticket
+        return self.update(add)
+    
+    def remove(self, ticket):
+        def remove(state):
+            state["tickets"].pop(str(ticket), None)
+        self.update(remove)
+    
+    def superseded(self, ticket):
+        return self.update(
+            lambda state: any(int(t) > ticket for t in state["tickets"])
+        )
+    
+    def first(self, ticket):
+        return self.update(
+            lambda state: not any(int(t) < ticket for t in state["tickets"])
+        )
@@ -0,0 +1,150 @@
+"""
+Connection setup shared by the HTTP handlers and the HTTP/2 transport.
+Resolved addresses are cached for a short while, and connection attempts
+race address families in the style of Happy Eyeballs (RFC 8305): the next
+address is tried 250ms after the previous one (or as soon as it fails), and
+the first connection to succeed wins. A broken IPv6 route therefore costs
+a quarter of a second rather than a full timeout.
+"""
+
+import errno
+import os
+import select
+import socket
+import threading
+import time
+
+from gondor import history
+
+
+CONNECTION_ATTEMPT_DELAY = 0.25
+IN_PROGRESS = set([errno.EINPROGRESS, errno.EWOULDBLOCK, errno.EALREADY])
+
+
+class DNSCache(object):
+    """
+    Caches getaddrinfo results. The system resolver does not report record
+    TTLs, so entries live for ttl seconds; an entry is also dropped as soon
+    as none of its addresses accept a connection.
+    """
+    
+    def __init__(self, ttl=60):
+        self.ttl = ttl
+        self.entries = {}
+        self.lock = threading.Lock()
+    
+    def resolve(self, host, port):
+        key = (host, port)
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[1] > time.time():
+                return entry[0]
+        # resolved outside the lock so one slow lookup does not block
+        # connections to other hosts
+        infos = socket.getaddrinfo(host, port, 0, socket.SOCK_STREAM)
+        with self.lock:
+            self.entries[key] = (infos, time.time() + self.ttl)
+        return infos
+    
+    def invalidate(self, host, port):
+        with self.lock:
+            self.entries.pop((host, port), None)
+
+
+cache = DNSCache()
+
+
+def interleave(infos):
+    """
+    Orders addresses alternating between families, starting with the family
+    the resolver preferred.
+    """
+    if not infos:
+        return []
+    first = [info for info in infos if info[0] == infos[0][0]]
+    rest = [info for info in infos if info[0] != infos[0][0]]
+    ordered = []
+    while first or rest:
+        if first:
+            ordered.append(first.pop(0))
+        if rest:
+            ordered.append(rest.pop(0))
+    return ordered
+
+
+def create_connection(address, timeout=socket._GLOBAL_DEFAULT_TIMEOUT, source_address=None):
+    """
+    Drop-in replacement for socket.create_connection.
+    """
+    host, port = address
+    if timeout is socket._GLOBAL_DEFAULT_TIMEOUT:
+        timeout = socket.getdefaulttimeout()
+    started = time.time()
+    if timeout is not None:
+        deadline = started + timeout
+    else:
+        deadline = None
+    queue = interleave(cache.resolve(host, port))
+    pending = {}
+    errors = []
+    winner = None
+    next_attempt = started
+    try:
+        while winner is None and (queue or pending):
+            now = time.time()
+            if deadline is not None and now >= deadline:
+                break
+            if queue and (not pending or now >= next_attempt):
+                family, socktype, proto, canonname, sockaddr = queue.pop(0)
+                sock = None
+                try:
+                    sock = socket.socket(family, socktype, proto)
+                    sock.setblocking(0)
+                    if source_address is not None:
+                        sock.bind(source_address)
+                    err = sock.connect_ex(sockaddr)
+                except socket.error, e:
+                    errors.append(e)
+                    if sock is not None:
+                        sock.close()
+                    continue
+                if err == 0:
+                    winner = sock
+                    break
+                if err not in IN_PROGRESS:
+                    errors.append(socket.error(err, os.strerror(err)))
+                    sock.close()
+                    continue
+                pending[sock] = sockaddr
+                next_attempt = now + CONNECTION_ATTEMPT_DELAY
+            waits = []
+            if queue:
+                waits.append(next_attempt - now)
+            if deadline is not None:
+                waits.append(deadline - now)
+            wait = max(min(waits), 0) if waits else None
+            writable = select.select([], list(pending), [], wait)[1]
+            for sock in writable:
+                err = sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+                if err == 0:
+                    winner = sock
+                    del pending[sock]
+                    break
+                errors.append(socket.error(err, os.strerror(err)))
+                del pending[sock]
+                sock.close()
+                # a failed attempt lets the next one start right away
+                next_attempt = time.time()
+    finally:
+        for sock in pending:
+            sock.close()
+    if winner is None:
+        cache.invalidate(host, port)
+        if deadline is not None and time.time() >= deadline:
+            raise socket.timeout("timed out")
+        if errors:
+            raise errors[-1]
+        raise socket.error("getaddrinfo returns an empty list")
+    winner.settimeout(timeout)
+    history.current().observe("connect", time.time() - started)
+    return winner
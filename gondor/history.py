@@ -0,0 +1,247 @@
+"""
+Local history of deploy, sqldump and manage operations. dispatch() records
+each one while it runs; commands mark the end of their phases with
+current().mark(name) and attach numbers with current().set(). An operation
+which returns without doing its work sets its own status (such as a queued
+deploy which was superseded). Records are appended as JSON lines to
+~/.gondor-history and summarized by gondor stats.
+"""
+
+import math
+import os
+import threading
+import time
+
+from contextlib import contextmanager
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+
+RECORDED = set(["deploy", "sqldump", "manage"])
+# neither a success nor a failure; left out of the duration quantiles
+SKIPPED = set(["superseded"])
+QUANTILES = [0.5, 0.95, 0.99]
+
+_local = threading.local()
+
+
+class Operation(object):
+    
+    def __init__(self, command, label=None):
+        self.started = self.marked = time.time()
+        self.record = {
+            "command": command,
+            "label": label,
+            "started": self.started,
+            "phases": {},
+        }
+    
+    def mark(self, phase):
+        """
+        Charges the time since the previous mark (or the start) to phase.
+        """
+        now = time.time()
+        phases = self.record["phases"]
+        phases[phase] = phases.get(phase, 0) + now - self.marked
+        self.marked = now
+    
+    def set(self, **fields):
+        self.record.update(fields)
+    
+    def observe(self, name, value):
+        """
+        Aggregates a measurement taken any number of times during the
+        operation (such as connect latency) into count, total and max.
+        """
+        observed = self.record.setdefault("observed", {})
+        stats = observed.setdefault(name, {"count": 0, "total": 0.0, "max": 0.0})
+        stats["count"] += 1
+        stats["total"] += value
+        stats["max"] = max(stats["max"], value)
+
+
+def current():
+    """
+    Returns the operation being recorded on this thread. Outside of a
+    recording a throwaway operation is returned so callers need not check.
+    """
+    operation = getattr(_local, "operation", None)
+    if operation is None:
+        operation = Operation(None)
+    return operation
+
+
+class History(object):
+    
+    def __init__(self, path=None):
+        if path is None:
+            path = os.path.expanduser("~/.gondor-history")
+        self.path = path
+    
+    def append(self, record):
+        line = "%s\n" % json.dumps(record, separators=(",", ":"))
+        # a single O_APPEND write keeps lines from concurrent processes whole
+        fd = os.open(self.path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0600)
+        try:
+            os.write(fd, line)
+        finally:
+            os.close(fd)
+    
+    def records(self, since=None):
+        try:
+            fp = open(self.path)
+        except IOError:
+            return
+        with fp:
+            for line in fp:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    # a line cut short by a crash
+                    continue
+                if since is None or record["started"] >= since:
+                    yield record
+    
+    @contextmanager
+    def recording(self, command, label=None):
+        operation = Operation(command, label)
+        _local.operation = operation
+        status = "error"
+        try:
+            yield operation
+            status = operation.record.get("status", "ok")
+        except SystemExit, e:
+            status = "ok" if not e.code else "failed"
+            raise
+        except KeyboardInterrupt:
+            status = "canceled"
+            raise
+        finally:
+            _local.operation = None
+            operation.record["status"] = status
+            operation.record["duration"] = time.time() - operation.started
+            try:
+                self.append(operation.record)
+            except (IOError, OSError):
+                pass
+
+
+def quantile(values, q):
+    """
+    Nearest-rank quantile of a sorted list.
+    """
+    index = max(int(math.ceil(q * len(values))) - 1, 0)
+    return values[index]
+
+
+def summarize(records):
+    """
+    Groups records by (command, label) and returns a list of summaries
+    sorted by command and label. Each summary holds the count, successes
+    (ok), failures (skipped operations are neither), duration quantiles,
+    per-phase quantiles, quantiles of each observed measurement's mean per
+    operation and the change in median duration between the older and newer
+    half of the records (trend).
+    """
+    groups = {}
+    for record in records:
+        groups.setdefault((record["command"], record["label"] or ""), []).append(record)
+    summaries = []
+    for (command, label), group in sorted(groups.items()):
+        group.sort(key=lambda r: r["started"])
+        durations = [r["duration"] for r in group if r["status"] == "ok"]
+        summary = {
+            "command": command,
+            "label": label,
+            "count": len(group),
+            "ok": len(durations),
+            "failures": len([r for r in group if r["status"] != "ok" and r["status"] not in SKIPPED]),
+            "sum": sum(durations),
+            "quantiles": None,
+            "phases": {},
+            "observed": {},
+            "trend": None,
+        }
+        if durations:
+            ordered = sorted(durations)
+            summary["quantiles"] = [quantile(ordered, q) for q in QUANTILES]
+            half = len(durations) // 2
+            if half:
+                older = sorted(durations[:half])
+                newer = sorted(durations[half:])
+                summary["trend"] = quantile(newer, 0.5) - quantile(older, 0.5)
+        phases = {}
+        for record in group:
+            if record["status"] == "ok":
+                for phase, seconds in record["phases"].iteritems():
+                    phases.setdefault(phase, []).append(seconds)
+        for phase, values in phases.iteritems():
+            values.sort()
+            summary["phases"][phase] = [quantile(values, q) for q in QUANTILES]
+        observed = {}
+        for record in group:
+            for name, stats in record.get("observed", {}).iteritems():
+                observed.setdefault(name, []).append(stats["total"] / stats["count"])
+        for name, values in observed.iteritems():
+            values.sort()
+            summary["observed"][name] = [quantile(values, q) for q in QUANTILES]
+        summaries.append(summary)
+    return summaries
+
+
+def prometheus(summaries):
+    """
+    Renders summaries in the Prometheus text exposition format (for the node
+    exporter's textfile collector).
+    """
+    def labels(summary, **extra):
+        pairs = [("command", summary["command"]), ("label", summary["label"])]
+        pairs.extend(sorted(extra.items()))
+        return ",".join(
+            '%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"'))
+            for k, v in pairs
+        )
+    lines = [
+        "# HELP gondor_operation_duration_seconds Duration of successful gondor operations.",
+        "# TYPE gondor_operation_duration_seconds summary",
+    ]
+    for summary in summaries:
+        if summary["quantiles"] is None:
+            continue
+        for q, value in zip(QUANTILES, summary["quantiles"]):
+            lines.append("gondor_operation_duration_seconds{%s} %f" % (labels(summary, quantile=q), value))
+        lines.append("gondor_operation_duration_seconds_sum{%s} %f" % (labels(summary), summary["sum"]))
+        lines.append("gondor_operation_duration_seconds_count{%s} %d" % (
+            labels(summary), summary["ok"]
+        ))
+    lines.extend([
+        "# HELP gondor_operation_phase_seconds Duration of phases of successful gondor operations.",
+        "# TYPE gondor_operation_phase_seconds gauge",
+    ])
+    for summary in summaries:
+        for phase, values in sorted(summary["phases"].items()):
+            for q, value in zip(QUANTILES, values):
+                lines.append("gondor_operation_phase_seconds{%s} %f" % (
+                    labels(summary, phase=phase, quantile=q), value
+                ))
+    for name in sorted(set(n for summary in summaries for n in summary["observed"])):
+        metric = "gondor_operation_%s_seconds" % name
+        lines.extend([
+            "# HELP %s Mean %s time per gondor operation." % (metric, name),
+            "# TYPE %s gauge" % metric,
+        ])
+        for summary in summaries:
+            if name not in summary["observed"]:
+                continue
+            for q, value in zip(QUANTILES, summary["observed"][name]):
+                lines.append("%s{%s} %f" % (metric, labels(summary, quantile=q), value))
+    lines.extend([
+        "# HELP gondor_operation_failures_total Failed or canceled gondor operations.",
+        "# TYPE gondor_operation_failures_total counter",
+    ])
+    for summary in summaries:
+        lines.append("gondor_operation_failures_total{%s} %d" % (labels(summary), summary["failures"]))
+    return "\n".join(lines) + "\n"
@@ -1,18 +1,26 @@
+import ctypes
+import ctypes.util
+import errno
 import httplib
 import mimetools
 import mimetypes
+import mmap
 import os
 import re
+import select
 import stat
 import socket
 import ssl
 import sys
+import threading
 import time
 import urllib
 import urllib2
 
 from cStringIO import StringIO
 
+from gondor import dualstack
+
 ucb = None # upload callback
 ubs = None # upload bytes sent
 ubt = None # upload bytes total
@@ -84,6 +92,20 @@ def match_hostname(cert, hostname):
             "subjectAltName fields were found")
 
 
+class HTTPConnection(httplib.HTTPConnection):
+    """
+    Plain HTTP connection set up through gondor.dualstack.
+    """
+    
+    def connect(self):
+        # source_address and tunnelling are not in Python 2.6's httplib
+        self.sock = dualstack.create_connection(
+            (self.host, self.port), self.timeout, getattr(self, "source_address", None)
+        )
+        if getattr(self, "_tunnel_host", None):
+            self._tunnel()
+
+
 class HTTPSConnection(httplib.HTTPConnection):
     """
     This class allows communication via SSL.
@@ -102,7 +124,7 @@ class HTTPSConnection(httplib.HTTPConnection):
         """
         Connect to a host on a given (SSL) port.
         """
-        sock = socket.create_connection((self.host, self.port), self.timeout)
+        sock = dualstack.create_connection((self.host, self.port), self.timeout)
         self.sock = ssl.wrap_socket(
             sock, self.key_file, self.cert_file,
             ca_certs=GONDOR_IO_CRT, cert_reqs=ssl.CERT_REQUIRED
@@ -120,53 +142,274 @@ class HTTPSHandler(urllib2.HTTPSHandler):
         return self.do_open(HTTPSConnection, request)
 
 
-def UploadProgressHandler(pb, ssl=False):
+class ConnectionPool(object):
+    """
+    Holds idle keep-alive connections keyed by connection class and host so
+    repeated API calls (status polls in particular) skip the TCP and TLS
+    handshake. Connections are checked out exclusively, making the pool safe
+    to share between threads.
+    """
+    
+    def __init__(self, max_idle=60):
+        self.max_idle = max_idle
+        self.connections = {}
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            idle = self.connections.get(key, [])
+            while idle:
+                conn, released = idle.pop()
+                if time.time() - released < self.max_idle:
+                    return conn
+                conn.close()
+        return None
+    
+    def put(self, key, conn):
+        with self.lock:
+            self.connections.setdefault(key, []).append((conn, time.time()))
+    
+    def clear(self):
+        with self.lock:
+            for idle in self.connections.values():
+                for conn, released in idle:
+                    conn.close()
+            self.connections = {}
+
+
+class PooledHandlerMixin(object):
+    """
+    Performs requests over connections borrowed from a ConnectionPool. The
+    response body is read eagerly (API responses are small JSON documents)
+    so the connection can go straight back to the pool.
+    """
+    
+    def __init__(self, pool):
+        urllib2.AbstractHTTPHandler.__init__(self)
+        self.pool = pool
+    
+    def do_open_pooled(self, conn_class, request):
+        host = request.get_host()
+        if not host:
+            raise urllib2.URLError("no host given")
+        headers = dict(request.unredirected_hdrs)
+        headers.update(dict(
+            (k, v) for k, v in request.headers.items() if k not in headers
+        ))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        key = (conn_class, host)
+        while True:
+            conn = self.pool.get(key)
+            reused = conn is not None
+            if conn is None:
+                conn = conn_class(host, timeout=request.timeout)
+            if hasattr(request.data, "seek"):
+                # httplib reads a MultipartBody through; rewind it in case
+                # an earlier attempt got part of the way
+                request.data.seek(0)
+            try:
+                conn.request(request.get_method(), request.get_selector(), request.data, headers)
+                r = conn.getresponse()
+                body = r.read()
+            except (socket.error, httplib.HTTPException), e:
+                conn.close()
+                if reused:
+                    # the server dropped an idle connection; try a fresh one
+                    continue
+                raise urllib2.URLError(e)
+            break
+        if r.will_close:
+            conn.close()
+        else:
+            self.pool.put(key, conn)
+        response = urllib.addinfourl(StringIO(body), r.msg, request.get_full_url())
+        response.code = r.status
+        response.msg = r.reason
+        return response
+
+
+class PooledHTTPHandler(PooledHandlerMixin, urllib2.HTTPHandler):
+    def http_open(self, request):
+        return self.do_open_pooled(HTTPConnection, request)
+
+
+class PooledHTTPSHandler(PooledHandlerMixin, urllib2.HTTPSHandler):
+    def https_open(self, request):
+        return self.do_open_pooled(HTTPSConnection, request)
+
+
+def UploadProgressHandler(meter, ssl=False, bucket=None):
     if ssl:
         conn_class = HTTPSConnection
         handler_class = urllib2.HTTPSHandler
     else:
-        conn_class = httplib.HTTPConnection
+        conn_class = HTTPConnection
         handler_class = urllib2.HTTPHandler
-    class HTTPConnection(conn_class):
+    class ProgressHTTPConnection(conn_class):
         def send(self, buf):
             global ubt, ubs
+            if not isinstance(buf, MultipartBody):
+                # request line and headers
+                conn_class.send(self, buf)
+                return
+            if self.sock is None:
+                self.connect()
             ubs = 0
-            ubt = send_length = len(buf)
-            cs = 8192
-            prev = 0
-            while ubs < send_length:
-                percentage = int(round((float(ubs) / ubt) * 100))
-                pb.updateAmount(percentage)
-                if percentage != prev:
-                    sys.stdout.write("%s\r" % pb)
-                    sys.stdout.flush()
-                    prev = percentage
-                t1 = time.time()
-                conn_class.send(self, buf[ubs:ubs+cs])
-                ubs += cs
-                t2 = time.time()
-            # once we are done uploading the file set the progress bar to
-            # 100% as sometimes it never gets full
-            pb.updateAmount(100)
-            sys.stdout.write("%s\r" % pb)
-            sys.stdout.flush()
+            ubt = len(buf)
+            meter.update(0, ubt)
+            def send_hook(size):
+                global ubs
+                if bucket is not None:
+                    bucket.consume(size)
+                ubs += size
+                meter.update(ubs)
+            buf.send(self.sock, send_hook)
+            meter.finish()
     class _UploadProgressHandler(handler_class):
         handler_order = urllib2.HTTPHandler.handler_order - 9 # run second
         if ssl:
             def https_open(self, request):
-                return self.do_open(HTTPConnection, request)
+                return self.do_open(ProgressHTTPConnection, request)
         else:
             def http_open(self, request):
-                return self.do_open(HTTPConnection, request)
+                return self.do_open(ProgressHTTPConnection, request)
+    # exposed for transports which bypass HTTPConnection (see gondor.http2)
+    _UploadProgressHandler.meter = meter
+    _UploadProgressHandler.bucket = bucket
     return _UploadProgressHandler
 
 
+def _libc_sendfile():
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        sendfile = libc.sendfile
+    except (OSError, AttributeError):
+        return None
+    sendfile.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.POINTER(ctypes.c_int64), ctypes.c_size_t]
+    sendfile.restype = ctypes.c_ssize_t
+    return sendfile
+
+_sendfile = _libc_sendfile()
+
+
+class FilePart(object):
+    """
+    A regular file inside a MultipartBody. It is never read into Python
+    memory when sent through send(): plain sockets get it through
+    sendfile(2) and TLS sockets are fed buffers over an mmap of the file.
+    """
+    
+    def __init__(self, fd):
+        self.fd = fd
+        self.length = os.fstat(fd.fileno()).st_size
+    
+    def send(self, sock, send_hook, blocksize):
+        if not self.length:
+            return
+        if _sendfile is not None and not isinstance(sock, ssl.SSLSocket):
+            self.sendfile(sock, send_hook, blocksize)
+            return
+        mm = mmap.mmap(self.fd.fileno(), self.length, access=mmap.ACCESS_READ)
+        try:
+            offset = 0
+            while offset < self.length:
+                count = min(blocksize, self.length - offset)
+                if send_hook is not None:
+                    send_hook(count)
+                end = offset + count
+                while offset < end:
+                    # buffer() is a view onto the mapping, not a copy
+                    offset += sock.send(buffer(mm, offset, end - offset))
+        finally:
+            mm.close()
+    
+    def sendfile(self, sock, send_hook, blocksize):
+        offset = ctypes.c_int64(0)
+        while offset.value < self.length:
+            count = min(blocksize, self.length - offset.value)
+            if send_hook is not None:
+                send_hook(count)
+            end = offset.value + count
+            while offset.value < end:
+                sent = _sendfile(sock.fileno(), self.fd.fileno(), ctypes.byref(offset), end - offset.value)
+                if sent < 0:
+                    err = ctypes.get_errno()
+                    if err == errno.EAGAIN:
+                        select.select([], [sock], [])
+                        continue
+                    raise socket.error(err, os.strerror(err))
+                if sent == 0:
+                    raise socket.error(errno.EPIPE, "file shrank while sending")
+    
+    def read(self, offset, size):
+        self.fd.seek(offset)
+        return self.fd.read(size)
+
+
+class MultipartBody(object):
+    """
+    A multipart/form-data body made of strings and FileParts. httplib and
+    HTTP/2 read it sequentially through read(); UploadProgressHandler calls
+    send() which hands file contents to the kernel without copying them.
+    """
+    
+    def __init__(self, parts):
+        self.parts = parts
+        self.length = sum(
+            len(part) if isinstance(part, str) else part.length
+            for part in parts
+        )
+        self.seek(0)
+    
+    def __len__(self):
+        return self.length
+    
+    def seek(self, position):
+        if position != 0:
+            raise IOError("MultipartBody can only be rewound")
+        self.index, self.offset = 0, 0
+    
+    def read(self, size=-1):
+        if size < 0:
+            size = self.length
+        chunks = []
+        while size and self.index < len(self.parts):
+            part = self.parts[self.index]
+            if isinstance(part, str):
+                chunk = part[self.offset:self.offset+size]
+                part_length = len(part)
+            else:
+                chunk = part.read(self.offset, size)
+                part_length = part.length
+            chunks.append(chunk)
+            size -= len(chunk)
+            self.offset += len(chunk)
+            if self.offset >= part_length:
+                self.index, self.offset = self.index + 1, 0
+        return "".join(chunks)
+    
+    def send(self, sock, send_hook=None, blocksize=64 * 1024):
+        for part in self.parts:
+            if isinstance(part, str):
+                # sliced like FileParts so throttling and progress stay
+                # smooth for bodies buffered from pipes
+                for offset in xrange(0, len(part), blocksize):
+                    count = min(blocksize, len(part) - offset)
+                    if send_hook is not None:
+                        send_hook(count)
+                    sock.sendall(buffer(part, offset, count))
+            else:
+                part.send(sock, send_hook, blocksize)
+
+
 class MultipartPostHandler(urllib2.BaseHandler):
     handler_order = urllib2.HTTPHandler.handler_order - 10 # run first
     
     def http_request(self, request):
         data = request.get_data()
-        if data is not None and not isinstance(data, str):
+        if data is not None and not isinstance(data, (str, MultipartBody)):
             params, files = [], []
             try:
                 if isinstance(data, dict):
@@ -188,11 +431,11 @@ class MultipartPostHandler(urllib2.BaseHandler):
     
     https_request = http_request
     
-    def multipart_encode(self, params, files, boundary=None, buf=None):
+    def multipart_encode(self, params, files, boundary=None):
         if boundary is None:
             boundary = mimetools.choose_boundary()
-        if buf is None:
-            buf = StringIO()
+        buf = StringIO()
+        parts = []
         for key, value in params:
             buf.write("--%s\r\n" % boundary)
             buf.write('Content-Disposition: form-data; name="%s"' % key)
@@ -202,7 +445,14 @@ class MultipartPostHandler(urllib2.BaseHandler):
             buf.write("--%s\r\n" % boundary)
             buf.write('Content-Disposition: form-data; name="%s"; filename="%s"\r\n' % (key, filename))
             buf.write("Content-Type: application/octet-stream\r\n")
-            buf.write("\r\n" + fd.read() + "\r\n")
+            buf.write("\r\n")
+            if stat.S_ISREG(os.fstat(fd.fileno()).st_mode):
+                parts.extend([buf.getvalue(), FilePart(fd)])
+                buf = StringIO()
+            else:
+                # pipes (manage reading stdin) have no length up front
+                buf.write(fd.read())
+            buf.write("\r\n")
         buf.write("--" + boundary + "--\r\n\r\n")
-        buf = buf.getvalue()
-        return boundary, buf
+        parts.append(buf.getvalue())
+        return boundary, MultipartBody(parts)
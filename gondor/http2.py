@@ -0,0 +1,294 @@
+"""
+Optional HTTP/2 transport. When enabled (http2 = on in the [api] section of
+~/.gondor) API calls to an endpoint that negotiates h2 through ALPN share a
+single TLS connection, with requests multiplexed as concurrent streams and
+headers compressed with HPACK. Endpoints which do not offer h2 (or a missing
+h2 package) fall back to the HTTP/1.1 handlers.
+
+Requires the h2 package.
+"""
+
+import httplib
+import select
+import socket
+import ssl
+import threading
+import urllib
+import urllib2
+
+from cStringIO import StringIO
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+
+from gondor import dualstack, http
+
+
+# hop-by-hop headers are not allowed in HTTP/2
+CONNECTION_HEADERS = set(["connection", "host", "keep-alive", "proxy-connection", "transfer-encoding", "upgrade"])
+
+
+class H2NotNegotiated(Exception):
+    pass
+
+
+class StreamResetError(httplib.HTTPException):
+    pass
+
+
+class Stream(object):
+    
+    def __init__(self):
+        self.status = None
+        self.headers = []
+        self.data = []
+        self.finished = False
+        self.error = None
+
+
+class Transport(object):
+    """
+    One TLS connection speaking HTTP/2. Any number of threads may issue
+    requests at once. All socket I/O happens under self.lock (OpenSSL
+    objects must not be used from two threads at once); whichever waiting
+    thread holds read_lock pumps incoming frames for everybody.
+    """
+    
+    def __init__(self, host, port, timeout):
+        self.authority = host if port == 443 else "%s:%d" % (host, port)
+        sock = dualstack.create_connection((host, port), timeout)
+        context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        context.verify_mode = ssl.CERT_REQUIRED
+        context.load_verify_locations(http.GONDOR_IO_CRT)
+        context.set_alpn_protocols(["h2", "http/1.1"])
+        self.sock = context.wrap_socket(sock, server_hostname=host)
+        try:
+            http.match_hostname(self.sock.getpeercert(), host)
+            if self.sock.selected_alpn_protocol() != "h2":
+                raise H2NotNegotiated(host)
+        except Exception:
+            self.sock.close()
+            raise
+        self.conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=True, header_encoding="utf-8")
+        )
+        self.lock = threading.Condition()
+        self.read_lock = threading.Lock()
+        self.streams = {}
+        self.error = None
+        with self.lock:
+            self.conn.initiate_connection()
+            self.flush()
+    
+    @property
+    def usable(self):
+        return self.error is None
+    
+    def flush(self):
+        data = self.conn.data_to_send()
+        if data:
+            self.sock.sendall(data)
+    
+    def fail(self, error):
+        self.error = error
+        for stream in self.streams.values():
+            stream.error = error
+            stream.finished = True
+        self.lock.notify_all()
+    
+    def handle(self, event):
+        if isinstance(event, h2.events.ConnectionTerminated):
+            self.fail(socket.error("HTTP/2 connection terminated (error code %s)" % event.error_code))
+            return
+        stream = self.streams.get(getattr(event, "stream_id", None))
+        if stream is None:
+            return
+        if isinstance(event, h2.events.ResponseReceived):
+            for name, value in event.headers:
+                if name == ":status":
+                    stream.status = int(value)
+                else:
+                    stream.headers.append((name, value))
+        elif isinstance(event, h2.events.DataReceived):
+            stream.data.append(event.data)
+            self.conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+        elif isinstance(event, h2.events.StreamEnded):
+            stream.finished = True
+        elif isinstance(event, h2.events.StreamReset):
+            stream.error = StreamResetError("stream reset (error code %s)" % event.error_code)
+            stream.finished = True
+    
+    def pump(self, timeout):
+        if not self.sock.pending():
+            if not select.select([self.sock], [], [], timeout)[0]:
+                return
+        with self.lock:
+            try:
+                data = self.sock.recv(65535)
+                if not data:
+                    raise socket.error("HTTP/2 connection closed by server")
+                for event in self.conn.receive_data(data):
+                    self.handle(event)
+                self.flush()
+            except socket.error, e:
+                self.fail(e)
+            except Exception, e:
+                self.fail(socket.error("HTTP/2 protocol error: %s" % e))
+            self.lock.notify_all()
+    
+    def wait(self, predicate):
+        while not predicate() and self.error is None:
+            if self.read_lock.acquire(False):
+                try:
+                    self.pump(0.1)
+                finally:
+                    self.read_lock.release()
+            else:
+                with self.lock:
+                    if not predicate():
+                        self.lock.wait(0.1)
+        if self.error is not None and not predicate():
+            raise self.error
+    
+    def send_body(self, stream_id, stream, body, send_hook):
+        # body is a string or a readable such as http.MultipartBody
+        if isinstance(body, str):
+            body = StringIO(body)
+        else:
+            body.seek(0)
+        while True:
+            self.wait(lambda: stream.finished or self.conn.local_flow_control_window(stream_id) > 0)
+            if stream.finished:
+                # the server answered (or reset the stream) before reading
+                # the whole body
+                return
+            data = body.read(min(
+                self.conn.local_flow_control_window(stream_id),
+                self.conn.max_outbound_frame_size
+            ))
+            if not data:
+                break
+            if send_hook is not None:
+                send_hook(len(data))
+            with self.lock:
+                self.conn.send_data(stream_id, data)
+                self.flush()
+        with self.lock:
+            self.conn.end_stream(stream_id)
+            self.flush()
+    
+    def request(self, method, path, headers, body, send_hook=None):
+        stream = Stream()
+        with self.lock:
+            if self.error is not None:
+                raise self.error
+            stream_id = self.conn.get_next_available_stream_id()
+            self.streams[stream_id] = stream
+            request_headers = [
+                (":method", method),
+                (":authority", self.authority),
+                (":scheme", "https"),
+                (":path", path),
+            ]
+            for name, value in headers.items():
+                if name.lower() not in CONNECTION_HEADERS:
+                    request_headers.append((name.lower(), str(value)))
+            self.conn.send_headers(stream_id, request_headers, end_stream=not body)
+            self.flush()
+        try:
+            if body:
+                self.send_body(stream_id, stream, body, send_hook)
+            self.wait(lambda: stream.finished)
+        finally:
+            with self.lock:
+                self.streams.pop(stream_id, None)
+        if stream.error is not None:
+            raise stream.error
+        return stream
+
+
+class TransportPool(object):
+    """
+    Hands out one shared Transport per host, remembering hosts which did not
+    negotiate h2 so they are not probed again.
+    """
+    
+    def __init__(self):
+        self.transports = {}
+        self.unsupported = set()
+        self.lock = threading.Lock()
+    
+    def get(self, host, port, timeout):
+        key = (host, port)
+        with self.lock:
+            if key in self.unsupported:
+                return None
+            transport = self.transports.get(key)
+            if transport is not None and transport.usable:
+                return transport
+            try:
+                transport = Transport(host, port, timeout)
+            except H2NotNegotiated:
+                self.unsupported.add(key)
+                return None
+            self.transports[key] = transport
+            return transport
+
+
+class HTTP2Handler(urllib2.BaseHandler):
+    # ahead of UploadProgressHandler so uploads share the connection too;
+    # returning None hands the request on to the HTTP/1.1 handlers
+    handler_order = urllib2.HTTPHandler.handler_order - 10
+    
+    def __init__(self, transports):
+        self.transports = transports
+    
+    def upload_hook(self):
+        # uploads carry a meter and bucket on their UploadProgressHandler
+        for handler in self.parent.handlers:
+            meter = getattr(handler, "meter", None)
+            if meter is not None:
+                bucket = handler.bucket
+                progress = {"sent": 0}
+                def send_hook(size):
+                    if bucket is not None:
+                        bucket.consume(size)
+                    progress["sent"] += size
+                    meter.update(progress["sent"])
+                return meter, send_hook
+        return None, None
+    
+    def https_open(self, request):
+        host, port = urllib.splitport(request.get_host())
+        port = int(port or 443)
+        try:
+            transport = self.transports.get(host, port, request.timeout)
+        except (socket.error, ssl.SSLError), e:
+            raise urllib2.URLError(e)
+        if transport is None:
+            return None
+        headers = dict(request.unredirected_hdrs)
+        headers.update(dict(
+            (k, v) for k, v in request.headers.items() if k not in headers
+        ))
+        body = request.get_data() or ""
+        meter, send_hook = self.upload_hook()
+        if meter is not None:
+            meter.update(0, len(body))
+        try:
+            stream = transport.request(request.get_method(), request.get_selector(), headers, body, send_hook)
+        except (socket.error, httplib.HTTPException), e:
+            raise urllib2.URLError(e)
+        if meter is not None:
+            meter.finish()
+        msg = httplib.HTTPMessage(StringIO("".join(
+            "%s: %s\r\n" % (name, value) for name, value in stream.headers
+        )))
+        response = urllib.addinfourl(StringIO("".join(stream.data)), msg, request.get_full_url())
+        response.code = stream.status
+        response.msg = httplib.responses.get(stream.status, "")
+        return response
@@ -0,0 +1,108 @@
+import sys
+import time
+
+from gondor.progressbar import ProgressBar
+
+
+def format_bytes(amount):
+    for unit in ["B", "KB", "MB", "GB"]:
+        if amount < 1024 or unit == "GB":
+            break
+        amount /= 1024.0
+    if unit == "B":
+        return "%d %s" % (amount, unit)
+    return "%.1f %s" % (amount, unit)
+
+
+def format_duration(seconds):
+    seconds = int(seconds)
+    if seconds >= 3600:
+        return "%d:%02d:%02d" % (seconds // 3600, seconds // 60 % 60, seconds % 60)
+    return "%d:%02d" % (seconds // 60, seconds % 60)
+
+
+class TransferMeter(object):
+    """
+    Reports progress of an upload or download on stderr. update() is cheap
+    and may be called for every chunk; output is only rendered every
+    interval seconds. On a terminal the meter redraws a single line; when
+    stderr is not a terminal it prints a plain line every line_interval
+    seconds so logs stay readable.
+    """
+    
+    def __init__(self, label, total=None, stream=None, interval=0.1, line_interval=10):
+        if stream is None:
+            stream = sys.stderr
+        self.label = label
+        self.total = total
+        self.stream = stream
+        self.tty = stream.isatty()
+        if self.tty:
+            self.interval = interval
+        else:
+            self.interval = line_interval
+        self.transferred = 0
+        self.started = None
+        self.ended = None
+        self.rendered = 0
+        self.finished = False
+    
+    def update(self, transferred, total=None):
+        if total is not None:
+            self.total = total
+        now = time.time()
+        if self.started is None:
+            self.started = self.rendered = now
+        self.transferred = transferred
+        if now - self.rendered >= self.interval:
+            self.rendered = now
+            self.render(now)
+    
+    def add(self, amount):
+        self.update(self.transferred + amount)
+    
+    def finish(self):
+        if self.finished or self.started is None:
+            return
+        self.finished = True
+        self.ended = time.time()
+        self.render(self.ended)
+        if self.tty:
+            self.stream.write("\n")
+            self.stream.flush()
+    
+    def stats(self, now):
+        elapsed = now - self.started
+        if elapsed > 0:
+            rate = self.transferred / elapsed
+        else:
+            rate = 0
+        if self.total and rate:
+            eta = max(self.total - self.transferred, 0) / rate
+        else:
+            eta = None
+        return elapsed, rate, eta
+    
+    def render(self, now):
+        elapsed, rate, eta = self.stats(now)
+        if self.total:
+            amount = "%s of %s" % (format_bytes(self.transferred), format_bytes(self.total))
+        else:
+            amount = format_bytes(self.transferred)
+        parts = [amount, "%s/s" % format_bytes(rate)]
+        if eta is not None and not self.finished:
+            parts.append("ETA %s" % format_duration(eta))
+        parts.append("%s elapsed" % format_duration(elapsed))
+        if self.tty:
+            if self.total:
+                pb = ProgressBar(0, self.total, 27)
+                pb.updateAmount(min(self.transferred, self.total))
+                bar = "%s " % pb
+            else:
+                bar = ""
+            line = "%s%s" % (bar, "  ".join(parts))
+            # pad so a shorter line fully overwrites the previous one
+            self.stream.write("\r%-78s" % line)
+        else:
+            self.stream.write("%s: %s\n" % (self.label, ", ".join(parts)))
+        self.stream.flush()
@@ -0,0 +1,107 @@
+"""
+Writing downloads to a file (gondor sqldump --output). Data is spooled to a
+temporary file next to the destination and renamed over it once complete
+and verified, so the destination always holds either the previous file or
+a whole new one, never a partial download.
+"""
+
+import hashlib
+import os
+import struct
+import tempfile
+import zlib
+
+
+class VerifyError(Exception):
+    pass
+
+
+class SpoolFile(object):
+    """
+    A file which appears at path only when commit() is called. close()
+    without commit() throws the data away.
+    """
+    
+    def __init__(self, path):
+        self.path = os.path.abspath(path)
+        fd, self.part_path = tempfile.mkstemp(
+            prefix=".%s." % os.path.basename(self.path),
+            suffix=".part",
+            dir=os.path.dirname(self.path)
+        )
+        self.fp = os.fdopen(fd, "wb")
+    
+    def write(self, data):
+        self.fp.write(data)
+    
+    def flush(self):
+        self.fp.flush()
+    
+    def commit(self):
+        self.fp.flush()
+        os.fsync(self.fp.fileno())
+        self.fp.close()
+        os.rename(self.part_path, self.path)
+        self.part_path = None
+    
+    def close(self):
+        if self.part_path is not None:
+            self.fp.close()
+            os.unlink(self.part_path)
+            self.part_path = None
+
+
+class GzipVerifier(object):
+    """
+    Checks a gzip stream as it passes through without keeping the inflated
+    data: every member must inflate cleanly (zlib checks each member's
+    CRC32) and the stream must end with the CRC32 and size trailer of its
+    last member, which catches truncation. The sha256 of the compressed
+    bytes is kept for comparison with the server's.
+    """
+    
+    def __init__(self, max_length=1024 * 1024):
+        self.max_length = max_length
+        self.sha = hashlib.sha256()
+        self.tail = ""
+        self.start_member()
+    
+    def start_member(self):
+        self.decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.crc = 0
+        self.size = 0
+    
+    def inflated(self, data):
+        self.crc = zlib.crc32(data, self.crc)
+        self.size += len(data)
+    
+    def update(self, chunk):
+        self.sha.update(chunk)
+        self.tail = (self.tail + chunk[-8:])[-8:]
+        try:
+            while chunk:
+                # max_length bounds memory on highly compressible dumps
+                self.inflated(self.decompressor.decompress(chunk, self.max_length))
+                if self.decompressor.unused_data:
+                    # the member ended and another one follows
+                    chunk = self.decompressor.unused_data
+                    self.start_member()
+                else:
+                    chunk = self.decompressor.unconsumed_tail
+        except zlib.error, e:
+            raise VerifyError("corrupt gzip stream (%s)" % e)
+    
+    def verify(self, sha256=None):
+        """
+        Raises VerifyError unless the stream ended with a matching trailer
+        and, when given, its sha256 matches.
+        """
+        try:
+            self.inflated(self.decompressor.flush())
+        except zlib.error, e:
+            raise VerifyError("corrupt gzip stream (%s)" % e)
+        trailer = struct.pack("<II", self.crc & 0xffffffff, self.size & 0xffffffff)
+        if self.tail != trailer:
+            raise VerifyError("gzip trailer does not match; the download is incomplete")
+        if sha256 is not None and self.sha.hexdigest() != sha256:
+            raise VerifyError("sha256 does not match Gondor's checksum")
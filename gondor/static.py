@@ -0,0 +1,99 @@
+"""
+Static asset manifests for deploys with staticfiles = on and
+static_manifest = on (or --static-manifest). Every asset under a directory
+named static in the project is hashed; the server is asked which hashes it
+does not have, only those are uploaded (as one bundle with members named by
+hash) and the assets are dropped from the deploy tarball. The manifest sent
+with the deploy maps each asset's path to its hash so the server can put the
+tree back together.
+"""
+
+import hashlib
+import os
+import tarfile
+
+from contextlib import closing
+
+
+# code and templates kept in a static directory stay in the tarball
+NON_ASSET_SUFFIXES = (".py", ".pyc", ".pyo")
+NON_ASSET_DIRS = set(["site_media", "templates"])
+
+
+def digest(fp, blocksize=64 * 1024):
+    sha = hashlib.sha256()
+    while True:
+        chunk = fp.read(blocksize)
+        if not chunk:
+            break
+        sha.update(chunk)
+    return sha.hexdigest()
+
+
+def is_static(path):
+    # collected output lives in site_media; only sources are shipped
+    dirs = path.split("/")[:-1]
+    if "static" not in dirs or NON_ASSET_DIRS.intersection(dirs):
+        return False
+    return not path.endswith(NON_ASSET_SUFFIXES)
+
+
+def collect(tar, prefix):
+    """
+    Returns {path: (sha256, member)} for the static assets under prefix in
+    an open tarfile. Paths are relative to prefix.
+    """
+    prefix = os.path.normpath(prefix)
+    assets = {}
+    for member in tar:
+        if not member.isfile():
+            continue
+        name = os.path.normpath(member.name)
+        if prefix != ".":
+            if not name.startswith(prefix + "/"):
+                continue
+            name = name[len(prefix) + 1:]
+        if is_static(name):
+            assets[name] = (digest(tar.extractfile(member)), member)
+    return assets
+
+
+def write_bundle(tar_path, assets, hashes, bundle_path):
+    """
+    Writes the assets whose hash is in hashes to a tar at bundle_path, each
+    once and named by its hash.
+    """
+    written = set()
+    with closing(tarfile.open(tar_path)) as tar:
+        with closing(tarfile.open(bundle_path, "w")) as bundle:
+            for sha, member in assets.itervalues():
+                if sha not in hashes or sha in written:
+                    continue
+                info = tarfile.TarInfo(sha)
+                info.size = member.size
+                info.mtime = member.mtime
+                bundle.addfile(info, tar.extractfile(member))
+                written.add(sha)
+    return len(written)
+
+
+def strip(tar_path, members):
+    """
+    Rewrites the tar at tar_path without the given members.
+    """
+    names = set(member.name for member in members)
+    tmp_path = "%s.tmp" % tar_path
+    try:
+        with closing(tarfile.open(tar_path)) as src:
+            with closing(tarfile.open(tmp_path, "w")) as dst:
+                for member in src:
+                    if member.name in names:
+                        continue
+                    if member.isfile():
+                        dst.addfile(member, src.extractfile(member))
+                    else:
+                        dst.addfile(member)
+        os.rename(tmp_path, tar_path)
+    finally:
+        if os.path.exists(tmp_path):
+            os.unlink(tmp_path)
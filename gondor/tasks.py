@@ -0,0 +1,141 @@
+"""
+Task status polling shared by every command running in the process (gondor
+batch and gondor agent run several at once). Polls for tasks on the same
+site are collected into rounds: a round waits briefly for other polls to
+join, then asks /task_status/ about all of them in one request and hands
+each poller its own result. Rounds for a site are at least min_interval
+apart, so the request rate depends on time rather than the number of tasks
+in flight.
+"""
+
+import threading
+import time
+import urllib
+import urllib2
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from gondor.api import make_api_call
+
+
+# parameters sent once per batched request rather than once per task
+COMMON_PARAMS = set(["version", "site_key"])
+
+
+class Poll(object):
+    
+    def __init__(self, params):
+        self.params = params
+        self.data = None
+        self.error = None
+        self.done = False
+
+
+class TaskRegistry(object):
+    
+    def __init__(self, min_interval=0.5, window=0.05):
+        self.min_interval = min_interval
+        self.window = window
+        self.lock = threading.Condition()
+        self.pending = {}
+        self.scheduled = set()
+        self.last_round = {}
+        # sites whose API answered a batched request with something else
+        self.unbatched = set()
+    
+    def status(self, config, endpoint, params):
+        """
+        Returns the decoded /task_status/ response for the task described by
+        params. Raises URLError like make_api_call.
+        """
+        key = (endpoint, params["site_key"], config["username"])
+        poll = Poll(params)
+        with self.lock:
+            self.pending.setdefault(key, []).append(poll)
+            leader = key not in self.scheduled
+            self.scheduled.add(key)
+        if leader:
+            self.run_round(config, endpoint, key)
+        with self.lock:
+            while not poll.done:
+                # a timeout keeps the wait interruptible by ^C
+                self.lock.wait(1)
+        if poll.error is not None:
+            raise poll.error
+        return poll.data
+    
+    def run_round(self, config, endpoint, key):
+        with self.lock:
+            start = max(time.time() + self.window, self.last_round.get(key, 0) + self.min_interval)
+        delay = start - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        with self.lock:
+            polls = self.pending.pop(key)
+            self.scheduled.discard(key)
+            self.last_round[key] = time.time()
+        try:
+            if len(polls) == 1 or key in self.unbatched:
+                self.fetch_each(config, endpoint, polls)
+            elif not self.fetch_batch(config, endpoint, polls):
+                self.unbatched.add(key)
+                self.fetch_each(config, endpoint, polls)
+        finally:
+            with self.lock:
+                for poll in polls:
+                    if poll.data is None and poll.error is None:
+                        poll.error = urllib2.URLError("task status round failed")
+                    poll.done = True
+                self.lock.notify_all()
+    
+    def fetch_each(self, config, endpoint, polls):
+        url = "%s/task_status/" % endpoint
+        for poll in polls:
+            try:
+                response = make_api_call(config, url, urllib.urlencode(poll.params))
+                poll.data = json.loads(response.read())
+            except urllib2.URLError, e:
+                poll.error = e
+    
+    def fetch_batch(self, config, endpoint, polls):
+        """
+        Asks for every poll's task in one request. Returns False when the
+        API does not understand batched requests.
+        """
+        params = dict(
+            (name, value) for name, value in polls[0].params.items()
+            if name in COMMON_PARAMS
+        )
+        params["tasks"] = json.dumps([
+            dict(
+                (name, value) for name, value in poll.params.items()
+                if name not in COMMON_PARAMS
+            )
+            for poll in polls
+        ])
+        url = "%s/task_status/" % endpoint
+        try:
+            response = make_api_call(config, url, urllib.urlencode(params))
+            data = json.loads(response.read())
+        except urllib2.HTTPError, e:
+            if e.code in (400, 404):
+                return False
+            for poll in polls:
+                poll.error = e
+            return True
+        except urllib2.URLError, e:
+            for poll in polls:
+                poll.error = e
+            return True
+        results = data.get("tasks")
+        if not isinstance(results, list) or len(results) != len(polls):
+            return False
+        for poll, result in zip(polls, results):
+            poll.data = result
+        return True
+
+
+registry = TaskRegistry()
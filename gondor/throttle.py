@@ -0,0 +1,83 @@
+import re
+import threading
+import time
+
+
+RE_RATE = re.compile(r"^\s*(\d+(?:\.\d+)?)\s*([kmg]?)b?\s*$", re.IGNORECASE)
+RATE_UNITS = {
+    "": 1,
+    "k": 1024,
+    "m": 1024 * 1024,
+    "g": 1024 * 1024 * 1024,
+}
+
+_buckets = {}
+_buckets_lock = threading.Lock()
+
+
+def parse_rate(value):
+    """
+    Parses a human rate such as "500k" or "2M" into bytes per second. Returns
+    None when value is empty or zero (meaning unlimited).
+    """
+    if value is None:
+        return None
+    if isinstance(value, (int, long, float)):
+        rate = value
+    else:
+        m = RE_RATE.match(value)
+        if m is None:
+            raise ValueError("invalid rate '%s' (examples: 500k, 2M)" % value)
+        rate = float(m.group(1)) * RATE_UNITS[m.group(2).lower()]
+    if rate <= 0:
+        return None
+    return int(rate)
+
+
+class TokenBucket(object):
+    """
+    A thread-safe token bucket measured in bytes. Callers consume tokens
+    before moving bytes over the wire; when the bucket is empty they sleep
+    until enough tokens have been refilled. Large requests are allowed to
+    drive the bucket into debt so chunk size does not need to be tuned to
+    the burst size.
+    """
+    
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        if burst is None:
+            # allow a quarter second of traffic to go out at once
+            burst = max(int(self.rate / 4), 1)
+        self.capacity = float(burst)
+        self.tokens = self.capacity
+        self.timestamp = time.time()
+        self.lock = threading.Lock()
+    
+    def _refill(self):
+        now = time.time()
+        self.tokens = min(self.capacity, self.tokens + (now - self.timestamp) * self.rate)
+        self.timestamp = now
+    
+    def consume(self, amount):
+        with self.lock:
+            self._refill()
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return
+            wait = -self.tokens / self.rate
+        time.sleep(wait)
+
+
+def get_bucket(rate):
+    """
+    Returns the process-wide bucket for the given rate (bytes per second) or
+    None when no limit is set. Every transfer asking for the same rate shares
+    one bucket so concurrent transfers respect a single aggregate cap.
+    """
+    if rate is None:
+        return None
+    with _buckets_lock:
+        bucket = _buckets.get(rate)
+        if bucket is None:
+            bucket = _buckets[rate] = TokenBucket(rate)
+        return bucket
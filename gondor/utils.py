@@ -1,6 +1,11 @@
+import ConfigParser
 import os
 import subprocess
 import sys
+import threading
+
+
+_config_cache = {}
 
 
 def run_proc(cmd, **kwargs):
@@ -21,6 +26,24 @@ def find_nearest(directory, search):
     raise OSError
 
 
+def read_config(path):
+    """
+    Returns a RawConfigParser loaded from path. Parsed files are cached until
+    their mtime changes.
+    """
+    try:
+        mtime = os.stat(path).st_mtime
+    except OSError:
+        mtime = None
+    cached = _config_cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    config = ConfigParser.RawConfigParser()
+    config.read(path)
+    _config_cache[path] = (mtime, config)
+    return config
+
+
 def out(msg):
     sys.stdout.write(msg)
     sys.stdout.flush()
@@ -35,3 +58,44 @@ def error(msg, exit=True):
     err("ERROR: %s" % msg)
     if exit:
         sys.exit(1)
+
+
+class ThreadLocalStream(object):
+    """
+    Stands in for sys.stdout/sys.stderr/sys.stdin in processes that run
+    several commands at once. Each thread may redirect the stream to its own
+    target; threads that do not fall back to the original stream.
+    """
+    
+    def __init__(self, default):
+        self.default = default
+        self.local = threading.local()
+    
+    def redirect(self, target):
+        self.local.target = target
+    
+    def target(self):
+        return getattr(self.local, "target", None) or self.default
+    
+    def __getattr__(self, name):
+        return getattr(self.target(), name)
+
+
+class NullInput(object):
+    """
+    Stdin for commands run on behalf of someone else (agent, batch). Reads
+    hit end of file immediately but isatty() answers as the caller's stdin
+    would.
+    """
+    
+    def __init__(self, tty=False):
+        self.tty = tty
+    
+    def read(self, size=-1):
+        return ""
+    
+    def readline(self, size=-1):
+        return ""
+    
+    def isatty(self):
+        return self.tty
@@ -0,0 +1,189 @@
+"""
+File system watchers used by gondor sync. On Linux the kernel's inotify
+interface is used through ctypes; elsewhere the tree is polled.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import sys
+import time
+
+
+IGNORED_DIRS = set([".git", ".hg", ".gondor", ".svn", "__pycache__"])
+IGNORED_SUFFIXES = (".pyc", ".pyo", ".swp", ".swx", "~")
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+
+WATCH_MASK = (
+    IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF
+)
+EVENT_HEADER = struct.Struct("iIII")
+
+
+def ignored(name):
+    return name in IGNORED_DIRS or name.endswith(IGNORED_SUFFIXES)
+
+
+def walk(root):
+    """
+    Yields (dirpath, filenames) for every directory under root which is not
+    ignored.
+    """
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [d for d in dirnames if not ignored(d)]
+        yield dirpath, [f for f in filenames if not ignored(f)]
+
+
+class PollingWatcher(object):
+    """
+    Detects changes by comparing (mtime, size) snapshots of the tree.
+    """
+    
+    def __init__(self, root, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self.snapshot = self.scan()
+    
+    def scan(self):
+        snapshot = {}
+        for dirpath, filenames in walk(self.root):
+            for filename in filenames:
+                path = os.path.join(dirpath, filename)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[path] = (st.st_mtime, st.st_size)
+        return snapshot
+    
+    def read(self, timeout):
+        """
+        Returns the set of paths changed since the last call, waiting up to
+        timeout seconds for something to change.
+        """
+        deadline = time.time() + timeout
+        while True:
+            snapshot = self.scan()
+            changed = set(
+                path for path in set(snapshot) | set(self.snapshot)
+                if snapshot.get(path) != self.snapshot.get(path)
+            )
+            self.snapshot = snapshot
+            remaining = deadline - time.time()
+            if changed or remaining <= 0:
+                return changed
+            time.sleep(min(self.interval, remaining))
+    
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """
+    Watches every directory in the tree with inotify. New directories are
+    watched as they appear; everything inside them counts as changed.
+    """
+    
+    def __init__(self, root):
+        self.root = root
+        self.libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self.fd = self.libc.inotify_init()
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), "inotify_init failed")
+        self.watches = {}
+        for dirpath, filenames in walk(root):
+            self.add_watch(dirpath)
+    
+    def add_watch(self, path):
+        wd = self.libc.inotify_add_watch(self.fd, path, WATCH_MASK)
+        if wd < 0:
+            err = ctypes.get_errno()
+            if err == errno.ENOSPC:
+                raise OSError(err, "inotify watch limit reached (see fs.inotify.max_user_watches)")
+            # the directory vanished before we got to it
+            return
+        self.watches[wd] = path
+    
+    def added_tree(self, path):
+        changed = set()
+        for dirpath, filenames in walk(path):
+            self.add_watch(dirpath)
+            changed.update(os.path.join(dirpath, f) for f in filenames)
+        return changed
+    
+    def read(self, timeout):
+        if not select.select([self.fd], [], [], timeout)[0]:
+            return set()
+        buf = os.read(self.fd, 64 * 1024)
+        changed = set()
+        offset = 0
+        while offset < len(buf):
+            wd, mask, cookie, length = EVENT_HEADER.unpack_from(buf, offset)
+            offset += EVENT_HEADER.size
+            name = buf[offset:offset+length].rstrip("\0")
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                # events were dropped; treat the whole tree as changed
+                sys.stderr.write("WARNING: inotify queue overflowed; resyncing everything\n")
+                return self.added_tree(self.root)
+            if mask & IN_IGNORED:
+                self.watches.pop(wd, None)
+                continue
+            directory = self.watches.get(wd)
+            if directory is None or not name or ignored(name):
+                continue
+            path = os.path.join(directory, name)
+            if mask & IN_ISDIR:
+                if mask & (IN_CREATE | IN_MOVED_TO):
+                    changed.update(self.added_tree(path))
+                elif mask & (IN_DELETE | IN_MOVED_FROM):
+                    # reported as a deleted path so its contents go with it
+                    changed.add(path)
+                continue
+            changed.add(path)
+        return changed
+    
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(root):
+    if sys.platform.startswith("linux"):
+        try:
+            return InotifyWatcher(root)
+        except (OSError, AttributeError):
+            # AttributeError: libc without inotify symbols
+            pass
+    return PollingWatcher(root)
+
+
+def debounced(watcher, window):
+    """
+    Yields sets of changed paths, each collected until the tree has been
+    quiet for window seconds.
+    """
+    while True:
+        changed = watcher.read(3600)
+        if not changed:
+            continue
+        while True:
+            more = watcher.read(window)
+            if not more:
+                break
+            changed |= more
+        yield changed
@@ -0,0 +1,152 @@
+"""
+Client side wheelhouse for deploys. Wheels for the app's requirements file
+are cached under ~/.gondor-wheelhouse, keyed by the requirements and the
+platform they are for. Only the wheels the server does not already hold are
+uploaded; the server then installs from them without touching the network or
+compiling anything.
+
+Wheels are for the target platform tag ([app] wheelhouse_platform, such as
+cp27-cp27mu-manylinux1_x86_64). When it is the client's own, they are built
+with pip wheel; otherwise pip download fetches binary wheels for the target
+(requirements without one make the build fail).
+"""
+
+import distutils.util
+import hashlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+
+from gondor import utils
+
+
+def platform_tag():
+    """
+    Returns the python-abi-platform tag of the running interpreter.
+    """
+    python = "cp%d%d" % sys.version_info[:2]
+    abi = python
+    if sys.version_info[0] == 2:
+        abi += "mu" if sys.maxunicode == 0x10ffff else "m"
+    platform = distutils.util.get_platform().replace("-", "_").replace(".", "_")
+    return "%s-%s-%s" % (python, abi, platform)
+
+
+def parse_tag(tag):
+    """
+    Splits a python-abi-platform tag (cp27-cp27mu-manylinux1_x86_64) into
+    its parts. Raises ValueError when tag is not one.
+    """
+    parts = tag.split("-")
+    if len(parts) != 3 or not parts[0].startswith("cp") or not parts[0][2:].isdigit():
+        raise ValueError("invalid platform tag '%s' (example: cp27-cp27mu-manylinux1_x86_64)" % tag)
+    return parts
+
+
+def cache_key(requirements, tag):
+    return hashlib.sha256("%s\0%s" % (tag, requirements)).hexdigest()
+
+
+def file_digest(path, blocksize=64 * 1024):
+    digest = hashlib.sha256()
+    with open(path, "rb") as fp:
+        while True:
+            chunk = fp.read(blocksize)
+            if not chunk:
+                break
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def read_requirements(tar, name):
+    """
+    Returns the contents of the requirements file name from an open tarfile
+    or None when the archive does not contain it.
+    """
+    name = os.path.normpath(name)
+    # hg archive -p . prefixes every member with ./
+    for candidate in [name, "./%s" % name]:
+        try:
+            member = tar.getmember(candidate)
+        except KeyError:
+            continue
+        return tar.extractfile(member).read()
+    return None
+
+
+class BuildError(Exception):
+    pass
+
+
+class Wheelhouse(object):
+    
+    def __init__(self, root=None):
+        if root is None:
+            root = os.path.expanduser("~/.gondor-wheelhouse")
+        self.root = root
+    
+    def path(self, key):
+        return os.path.join(self.root, key)
+    
+    def wheels(self, key):
+        """
+        Returns [(filename, path, sha256)] for a complete wheelhouse or None
+        when key has not been built yet.
+        """
+        path = self.path(key)
+        if not os.path.exists(os.path.join(path, ".complete")):
+            return None
+        wheels = []
+        for filename in sorted(os.listdir(path)):
+            if filename.endswith(".whl"):
+                wheel_path = os.path.join(path, filename)
+                wheels.append((filename, wheel_path, file_digest(wheel_path)))
+        return wheels
+    
+    def build(self, key, requirements, tag):
+        """
+        Gets wheels for requirements on the platform tag and stores them
+        under key.
+        """
+        if not os.path.exists(self.root):
+            os.makedirs(self.root)
+        # built next to its final location so the rename is atomic
+        build_dir = tempfile.mkdtemp(prefix=".build-", dir=self.root)
+        try:
+            requirements_path = os.path.join(build_dir, "requirements.txt")
+            with open(requirements_path, "w") as fp:
+                fp.write(requirements)
+            wheel_dir = os.path.join(build_dir, "wheels")
+            os.mkdir(wheel_dir)
+            if tag == platform_tag():
+                command = [
+                    sys.executable, "-m", "pip", "wheel",
+                    "--wheel-dir", wheel_dir, "-r", requirements_path
+                ]
+            else:
+                python, abi, platform = parse_tag(tag)
+                command = [
+                    sys.executable, "-m", "pip", "download",
+                    "--only-binary=:all:",
+                    "--implementation", "cp",
+                    "--python-version", python[2:],
+                    "--abi", abi,
+                    "--platform", platform,
+                    "--dest", wheel_dir, "-r", requirements_path
+                ]
+            check, output = utils.run_proc(command, stderr=subprocess.STDOUT)
+            if check != 0:
+                # the end of pip's output is where it says what went wrong
+                raise BuildError("\n".join(output.splitlines()[-10:]))
+            open(os.path.join(wheel_dir, ".complete"), "w").close()
+            path = self.path(key)
+            if os.path.exists(path):
+                shutil.rmtree(path)
+            os.rename(wheel_dir, path)
+        except (IOError, OSError), e:
+            raise BuildError(str(e))
+        finally:
+            shutil.rmtree(build_dir, ignore_errors=True)
+        return self.wheels(key)
@@ -26,8 +26,11 @@ setup(
     zip_safe = False,
     entry_points = {
         "console_scripts": [
-            "gondor = gondor.__main__:main",
+            "gondor = gondor.client:main",
         ],
     },
     install_requires = install_requires,
+    extras_require = {
+        "http2": ["h2"],
+    },
 )
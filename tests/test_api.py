@@ -0,0 +1,133 @@
+import BaseHTTPServer
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from StringIO import StringIO
+
+from gondor import api, http, throttle
+from gondor.meter import TransferMeter
+
+
+class RetryHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    
+    protocol_version = "HTTP/1.1"
+    # a retry which sends no body would otherwise hang the test
+    timeout = 5
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_POST(self):
+        length = int(self.headers["Content-Length"])
+        body = self.rfile.read(length)
+        self.server.bodies.append(body)
+        if len(self.server.bodies) == 1:
+            status, reply = 503, "busy"
+        else:
+            status, reply = 200, "{}"
+        self.send_response(status)
+        self.send_header("Content-Length", str(len(reply)))
+        self.end_headers()
+        self.wfile.write(reply)
+
+
+class MultipartRetryTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), RetryHandler)
+        self.server.bodies = []
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        self.policy = api.policy
+        api.policy = api.RetryPolicy(backoff=0)
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, "wb") as fp:
+            fp.write("x" * 100000)
+    
+    def tearDown(self):
+        api.policy = self.policy
+        api.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        os.unlink(self.path)
+    
+    def test_retried_multipart_post_sends_full_body(self):
+        url = "http://127.0.0.1:%d/upload/" % self.server.server_address[1]
+        config = {"username": "u", "password": "p"}
+        with open(self.path, "rb") as fp:
+            api.make_api_call(config, url, {"label": "x", "upload": fp},
+                extra_handlers=[http.MultipartPostHandler]
+            )
+        self.assertEqual(len(self.server.bodies), 2)
+        self.assertEqual(self.server.bodies[0], self.server.bodies[1])
+        self.assertTrue(len(self.server.bodies[1]) > 100000)
+
+
+class TimingHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    
+    protocol_version = "HTTP/1.1"
+    timeout = 5
+    
+    def log_message(self, *args):
+        pass
+    
+    def do_POST(self):
+        remaining = int(self.headers["Content-Length"])
+        received = []
+        while remaining:
+            chunk = self.rfile.read(min(remaining, 16 * 1024))
+            if not chunk:
+                break
+            received.append((time.time(), chunk))
+            remaining -= len(chunk)
+        self.server.received = received
+        self.send_response(200)
+        self.send_header("Content-Length", "2")
+        self.end_headers()
+        self.wfile.write("{}")
+
+
+class ThrottledPipeUploadTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.server = BaseHTTPServer.HTTPServer(("127.0.0.1", 0), TimingHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+    
+    def tearDown(self):
+        api.pool.clear()
+        self.server.shutdown()
+        self.server.server_close()
+    
+    def test_piped_body_is_sent_at_the_limited_rate(self):
+        size = 512 * 1024
+        r, w = os.pipe()
+        def feed():
+            with os.fdopen(w, "wb") as fp:
+                fp.write("x" * size)
+        writer = threading.Thread(target=feed)
+        writer.start()
+        meter = TransferMeter("upload", stream=StringIO())
+        bucket = throttle.TokenBucket(1024 * 1024)
+        url = "http://127.0.0.1:%d/manage/" % self.server.server_address[1]
+        config = {"username": "u", "password": "p"}
+        with os.fdopen(r, "rb") as stdin:
+            api.make_api_call(config, url, {"label": "x", "stdin": stdin}, extra_handlers=[
+                http.MultipartPostHandler,
+                http.UploadProgressHandler(meter, ssl=False, bucket=bucket),
+            ])
+        writer.join()
+        received = self.server.received
+        self.assertTrue(sum(len(chunk) for t, chunk in received) > size)
+        # half a MiB at 1 MiB/s with a quarter second burst arrives over
+        # roughly a quarter second, not all at once
+        self.assertTrue(received[-1][0] - received[0][0] > 0.15)
+
+
+if __name__ == "__main__":
+    unittest.main()
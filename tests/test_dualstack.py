@@ -0,0 +1,168 @@
+import select
+import socket
+import time
+import unittest
+
+from gondor import dualstack
+
+
+def listener(family, host):
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.bind((host, 0))
+    sock.listen(5)
+    return sock
+
+
+def has_ipv6():
+    try:
+        listener(socket.AF_INET6, "::1").close()
+    except socket.error:
+        return False
+    return True
+
+
+class StaticResolver(object):
+    """
+    Stands in for dualstack.cache, answering every lookup with infos.
+    """
+    
+    def __init__(self, infos):
+        self.infos = infos
+        self.invalidated = []
+    
+    def resolve(self, host, port):
+        return self.infos
+    
+    def invalidate(self, host, port):
+        self.invalidated.append((host, port))
+
+
+class FilteredSelect(object):
+    """
+    Stands in for the select module, never reporting sockets which writable
+    rejects as writable (a black hole for those connection attempts).
+    """
+    
+    def __init__(self, writable):
+        self.writable = writable
+    
+    def select(self, r, w, x, timeout=None):
+        w = [sock for sock in w if self.writable(sock)]
+        if not w:
+            time.sleep(timeout if timeout is not None else 0.05)
+            return [], [], []
+        return select.select(r, w, x, timeout)
+
+
+class CreateConnectionTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.cache = dualstack.cache
+        self.sockets = []
+    
+    def tearDown(self):
+        dualstack.cache = self.cache
+        dualstack.select = select
+        for sock in self.sockets:
+            sock.close()
+    
+    def listen(self, family, host):
+        sock = listener(family, host)
+        self.sockets.append(sock)
+        return sock
+    
+    def v4_info(self, port):
+        return (socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", ("127.0.0.1", port))
+    
+    def v6_info(self, port):
+        return (socket.AF_INET6, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", ("::1", port, 0, 0))
+    
+    def refused_v6_port(self):
+        # a port which was listening a moment ago refuses connections now
+        sock = listener(socket.AF_INET6, "::1")
+        port = sock.getsockname()[1]
+        sock.close()
+        return port
+    
+    @unittest.skipUnless(has_ipv6(), "no IPv6 loopback")
+    def test_refused_ipv6_falls_back_to_ipv4(self):
+        v4 = self.listen(socket.AF_INET, "127.0.0.1")
+        port = v4.getsockname()[1]
+        dualstack.cache = StaticResolver([self.v6_info(self.refused_v6_port()), self.v4_info(port)])
+        started = time.time()
+        sock = dualstack.create_connection(("example.com", port), timeout=5)
+        self.sockets.append(sock)
+        self.assertEqual(sock.family, socket.AF_INET)
+        self.assertEqual(sock.getpeername(), ("127.0.0.1", port))
+        # a refusal lets the next attempt start without waiting
+        self.assertTrue(time.time() - started < dualstack.CONNECTION_ATTEMPT_DELAY)
+    
+    @unittest.skipUnless(has_ipv6(), "no IPv6 loopback")
+    def test_black_holed_ipv6_loses_the_race(self):
+        v4 = self.listen(socket.AF_INET, "127.0.0.1")
+        v6 = self.listen(socket.AF_INET6, "::1")
+        dualstack.cache = StaticResolver([
+            self.v6_info(v6.getsockname()[1]),
+            self.v4_info(v4.getsockname()[1]),
+        ])
+        dualstack.select = FilteredSelect(lambda sock: sock.family == socket.AF_INET)
+        started = time.time()
+        sock = dualstack.create_connection(("example.com", 80), timeout=5)
+        self.sockets.append(sock)
+        elapsed = time.time() - started
+        self.assertEqual(sock.family, socket.AF_INET)
+        self.assertTrue(dualstack.CONNECTION_ATTEMPT_DELAY * 0.9 <= elapsed < 2)
+    
+    def test_timeout(self):
+        v4 = self.listen(socket.AF_INET, "127.0.0.1")
+        port = v4.getsockname()[1]
+        resolver = dualstack.cache = StaticResolver([self.v4_info(port)])
+        dualstack.select = FilteredSelect(lambda sock: False)
+        started = time.time()
+        self.assertRaises(socket.timeout, dualstack.create_connection, ("example.com", port), 0.3)
+        self.assertTrue(0.3 <= time.time() - started < 2)
+        # a failed connection drops the cached addresses
+        self.assertEqual(resolver.invalidated, [("example.com", port)])
+    
+    def test_refused_everywhere(self):
+        sock = listener(socket.AF_INET, "127.0.0.1")
+        port = sock.getsockname()[1]
+        sock.close()
+        dualstack.cache = StaticResolver([self.v4_info(port)])
+        self.assertRaises(socket.error, dualstack.create_connection, ("example.com", port), 5)
+
+
+class DNSCacheTest(unittest.TestCase):
+    
+    def setUp(self):
+        self.getaddrinfo = socket.getaddrinfo
+        self.lookups = []
+        def getaddrinfo(host, port, *args):
+            self.lookups.append((host, port))
+            return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", ("127.0.0.1", port))]
+        socket.getaddrinfo = getaddrinfo
+    
+    def tearDown(self):
+        socket.getaddrinfo = self.getaddrinfo
+    
+    def test_entries_are_reused_until_they_expire(self):
+        cache = dualstack.DNSCache(ttl=0.2)
+        cache.resolve("example.com", 443)
+        cache.resolve("example.com", 443)
+        self.assertEqual(len(self.lookups), 1)
+        cache.resolve("example.com", 80)
+        self.assertEqual(len(self.lookups), 2)
+        time.sleep(0.3)
+        cache.resolve("example.com", 443)
+        self.assertEqual(len(self.lookups), 3)
+    
+    def test_invalidate(self):
+        cache = dualstack.DNSCache(ttl=60)
+        cache.resolve("example.com", 443)
+        cache.invalidate("example.com", 443)
+        cache.resolve("example.com", 443)
+        self.assertEqual(len(self.lookups), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
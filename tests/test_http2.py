@@ -0,0 +1,207 @@
+import hashlib
+import os
+import socket
+import ssl
+import tempfile
+import threading
+import unittest
+import urllib
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import h2.config
+    import h2.connection
+    import h2.events
+except ImportError:
+    h2 = None
+
+from gondor import api, http, http2
+
+
+# self-signed certificate and key for localhost
+CERT = os.path.join(os.path.dirname(os.path.abspath(__file__)), "localhost.pem")
+
+
+class Server(object):
+    """
+    A TLS server on localhost which answers every request with a JSON
+    document describing the body it received. It speaks HTTP/2 when alpn
+    is h2 and (one request per connection) HTTP/1.1 otherwise.
+    """
+    
+    def __init__(self, alpn):
+        self.context = ssl.SSLContext(ssl.PROTOCOL_SSLv23)
+        self.context.load_cert_chain(CERT)
+        self.context.set_alpn_protocols([alpn])
+        self.listener = socket.socket()
+        self.listener.bind(("127.0.0.1", 0))
+        self.listener.listen(16)
+        self.port = self.listener.getsockname()[1]
+        self.connections = 0
+        self.requests = []
+        self.lock = threading.Lock()
+        thread = threading.Thread(target=self.accept)
+        thread.daemon = True
+        thread.start()
+    
+    def close(self):
+        self.listener.close()
+    
+    def accept(self):
+        while True:
+            try:
+                sock = self.listener.accept()[0]
+                sock = self.context.wrap_socket(sock, server_side=True)
+            except (socket.error, ssl.SSLError):
+                return
+            with self.lock:
+                self.connections += 1
+            thread = threading.Thread(target=self.serve, args=(sock,))
+            thread.daemon = True
+            thread.start()
+    
+    def reply(self, headers, body):
+        with self.lock:
+            self.requests.append((headers, body))
+        return json.dumps({
+            "status": "success",
+            "length": len(body),
+            "sha1": hashlib.sha1(body).hexdigest(),
+        })
+    
+    def serve(self, sock):
+        try:
+            if sock.selected_alpn_protocol() == "h2":
+                self.serve_h2(sock)
+            else:
+                self.serve_http11(sock)
+        except (socket.error, ssl.SSLError):
+            pass
+        finally:
+            sock.close()
+    
+    def serve_http11(self, sock):
+        data = ""
+        while "\r\n\r\n" not in data:
+            data += sock.recv(65535)
+        head, body = data.split("\r\n\r\n", 1)
+        headers = dict(
+            (name.lower(), value.strip())
+            for name, value in (line.split(":", 1) for line in head.split("\r\n")[1:])
+        )
+        while len(body) < int(headers.get("content-length", 0)):
+            body += sock.recv(65535)
+        reply = self.reply(headers, body)
+        sock.sendall("HTTP/1.1 200 OK\r\nContent-Length: %d\r\nConnection: close\r\n\r\n%s" % (
+            len(reply), reply
+        ))
+    
+    def serve_h2(self, sock):
+        conn = h2.connection.H2Connection(
+            config=h2.config.H2Configuration(client_side=False, header_encoding="utf-8")
+        )
+        conn.initiate_connection()
+        sock.sendall(conn.data_to_send())
+        streams = {}
+        while True:
+            data = sock.recv(65535)
+            if not data:
+                return
+            for event in conn.receive_data(data):
+                if isinstance(event, h2.events.RequestReceived):
+                    streams[event.stream_id] = (dict(event.headers), [])
+                elif isinstance(event, h2.events.DataReceived):
+                    streams[event.stream_id][1].append(event.data)
+                    conn.acknowledge_received_data(event.flow_controlled_length, event.stream_id)
+                elif isinstance(event, h2.events.StreamEnded):
+                    headers, chunks = streams.pop(event.stream_id)
+                    reply = self.reply(headers, "".join(chunks))
+                    conn.send_headers(event.stream_id, [
+                        (":status", "200"),
+                        ("content-type", "application/json"),
+                        ("content-length", str(len(reply))),
+                    ])
+                    conn.send_data(event.stream_id, reply, end_stream=True)
+            sock.sendall(conn.data_to_send())
+
+
+@unittest.skipIf(h2 is None, "h2 is not installed")
+class HTTP2Test(unittest.TestCase):
+    
+    def setUp(self):
+        self.crt = http.GONDOR_IO_CRT
+        http.GONDOR_IO_CRT = CERT
+        self.transports = api.h2_transports
+        api.h2_transports = http2.TransportPool()
+        self.config = {"username": "u", "password": "p", "http2": True}
+        self.server = None
+    
+    def tearDown(self):
+        http.GONDOR_IO_CRT = self.crt
+        for transport in api.h2_transports.transports.values():
+            transport.sock.close()
+        api.h2_transports = self.transports
+        api.pool.clear()
+        if self.server is not None:
+            self.server.close()
+    
+    def url(self, path):
+        return "https://localhost:%d%s" % (self.server.port, path)
+    
+    def test_concurrent_calls_share_one_connection(self):
+        self.server = Server("h2")
+        results = []
+        def call(n):
+            response = api.make_api_call(self.config, self.url("/task_status/"), urllib.urlencode({"n": n}))
+            results.append(json.loads(response.read()))
+        threads = [threading.Thread(target=call, args=(n,)) for n in range(10)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(results), 10)
+        self.assertTrue(all(result["status"] == "success" for result in results))
+        self.assertEqual(self.server.connections, 1)
+        self.assertEqual(
+            sorted(body for headers, body in self.server.requests),
+            sorted(urllib.urlencode({"n": n}) for n in range(10))
+        )
+    
+    def test_multipart_upload(self):
+        self.server = Server("h2")
+        # larger than the initial flow control window
+        content = os.urandom(300 * 1024)
+        fd, path = tempfile.mkstemp()
+        try:
+            with os.fdopen(fd, "wb") as fp:
+                fp.write(content)
+            with open(path, "rb") as fp:
+                response = api.make_api_call(
+                    self.config, self.url("/deploy/"), {"label": "x", "tarball": fp},
+                    extra_handlers=[http.MultipartPostHandler]
+                )
+                result = json.loads(response.read())
+        finally:
+            os.unlink(path)
+        headers, body = self.server.requests[0]
+        self.assertEqual(result["length"], int(headers["content-length"]))
+        self.assertEqual(result["sha1"], hashlib.sha1(body).hexdigest())
+        self.assertTrue(content in body)
+        self.assertEqual(self.server.connections, 1)
+    
+    def test_falls_back_when_alpn_picks_http11(self):
+        self.server = Server("http/1.1")
+        response = api.make_api_call(self.config, self.url("/list/"), urllib.urlencode({"n": 1}))
+        self.assertEqual(json.loads(response.read())["status"], "success")
+        self.assertTrue(("localhost", self.server.port) in api.h2_transports.unsupported)
+        # known hosts are not probed again
+        api.make_api_call(self.config, self.url("/list/"), urllib.urlencode({"n": 2}))
+        self.assertEqual(self.server.connections, 3)
+
+
+if __name__ == "__main__":
+    unittest.main()